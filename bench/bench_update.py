@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Offline benchmark for the update-and-test path (what 'u' / `vpn.py test` run).
+# Everything is local: synthetic base64 subscriptions and the 204 test target come from an in-process HTTP server,
+# "servers" are local TCP listeners (alive) or closed ports (dead), and xray is replaced by stub_xray.py.
+#
+#   python bench/bench_update.py --subs 4 --servers 2000 --alive 0.2
+#   python bench/bench_update.py --json >> bench_output.txt
+import argparse
+import asyncio
+import base64
+import http.server
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+STUB_XRAY = BENCH_DIR / "stub_xray.py"
+
+# --- Synthetic Subscriptions ---
+def make_link(i: int, port: int, rng: random.Random) -> str:
+    name, uid = f"bench-{i}", f"00000000-0000-4000-8000-{i:012d}"
+    proto = rng.choice(("vmess", "vless", "trojan", "ss"))
+    if proto == "vmess":
+        conf = {"v": "2", "ps": name, "add": "127.0.0.1", "port": port, "id": uid, "aid": 0, "net": "tcp", "tls": ""}
+        return "vmess://" + base64.b64encode(json.dumps(conf).encode()).decode()
+    if proto == "vless": return f"vless://{uid}@127.0.0.1:{port}?encryption=none&type=tcp#{name}"
+    if proto == "trojan": return f"trojan://pw{i}@127.0.0.1:{port}?security=none&type=tcp#{name}"
+    return "ss://" + base64.urlsafe_b64encode(f"aes-128-gcm:pw{i}".encode()).decode().rstrip("=") + f"@127.0.0.1:{port}#{name}"
+
+def closed_port() -> int:
+    with socket.socket() as s: s.bind(("127.0.0.1", 0)); return s.getsockname()[1] # Freed on exit: connects are refused
+
+def build_subscriptions(n_subs: int, per_sub: int, alive_ratio: float, alive_port: int, seed: int) -> dict:
+    rng, dead_port = random.Random(seed), closed_port()
+    subs = {}
+    for k in range(n_subs):
+        links = [make_link(k * per_sub + i, alive_port if rng.random() < alive_ratio else dead_port, rng) for i in range(per_sub)]
+        subs[f"/sub/{k}"] = base64.b64encode("\n".join(links).encode())
+    return subs
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    subs: dict = {}
+    def do_GET(self) -> None:
+        if self.path.startswith("/__down?bytes="): return self.send_payload(int(self.path.split("=", 1)[1]))
+        body = self.subs.get(self.path)
+        self.send_response(200 if body is not None else 204)
+        self.send_header("Content-Length", str(len(body or b""))); self.end_headers()
+        if body: self.wfile.write(body)
+    def send_payload(self, size: int) -> None: # Local stand-in for the throughput payload URL
+        self.send_response(200); self.send_header("Content-Length", str(size)); self.end_headers()
+        chunk = b"\0" * 65536
+        try:
+            for off in range(0, size, len(chunk)): self.wfile.write(chunk[:size - off])
+        except OSError: pass # Client stops early once it has enough
+    def log_message(self, *args) -> None: pass
+
+# --- Measurement ---
+def peak_rss_kb() -> tuple[int, int]:
+    # ru_maxrss is KiB on Linux. Children: largest single reaped child (stub xray), not a sum.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+async def run_once(core, sub_urls: list, throughput_n: int = 0, prescreen: bool = True, workers: int = 0) -> dict:
+    first_result: list = []
+    t0 = time.perf_counter()
+    alive: list = []
+    def on_result(res: dict) -> None:
+        if not first_result: first_result.append(time.perf_counter() - t0)
+        alive.append(res)
+    http, health = core.HttpClient(), core.HealthStore(core.HEALTH_DB_FILE)
+    try:
+        pipeline = core.UpdatePipeline(http, health, {}, lambda msg, is_error=False, fold=None: None, on_result, force_full=True, prescreen=prescreen, workers=workers)
+        await pipeline.run([{"name": f"bench{i}", "url": u, "last_update": "Never"} for i, u in enumerate(sub_urls)])
+        wall = time.perf_counter() - t0
+        tp = await pipeline.run_throughput(alive, throughput_n) if throughput_n else []
+    finally: http.close(); health.close()
+    rates = [r["throughput"]["bytes_per_sec"] for r in tp if r["throughput"]["bytes_per_sec"]]
+    return {"throughput_tested": len(tp), "throughput_best_bps": round(max(rates)) if rates else None,
+            "wall_s": round(wall, 3), "first_result_s": round(first_result[0], 3) if first_result else None,
+            "tested_per_s": round(pipeline.stats["tested"] / wall, 1) if wall else None, **pipeline.stats}
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Offline benchmark for the update-and-test pipeline.")
+    ap.add_argument("--subs", type=int, default=2, help="number of subscriptions")
+    ap.add_argument("--servers", type=int, default=500, help="links per subscription")
+    ap.add_argument("--alive", type=float, default=0.2, help="fraction of servers that are alive")
+    ap.add_argument("--xray-start-delay", type=float, default=0.05, help="stub xray startup delay (s)")
+    ap.add_argument("--xray-fail-rate", type=float, default=0.0, help="probability a stub xray spawn fails")
+    ap.add_argument("--throughput", type=int, default=0, metavar="N", help="also bandwidth-test the N best servers (local payload)")
+    ap.add_argument("--payload-bytes", type=int, default=20_000_000, help="size of the local throughput payload")
+    ap.add_argument("--no-prescreen", action="store_true", help="skip the direct TCP pre-screen (every server costs an Xray slot)")
+    ap.add_argument("--workers", type=int, default=0, help="shard the Xray stage across N worker processes (0: in-process)")
+    ap.add_argument("--runs", type=int, default=1, help="repeat the run N times (fresh state each time)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="print one JSON line per run")
+    args = ap.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="vpn_bench_"))
+    os.environ["HOME"] = str(work_dir) # vpn_core derives CONFIG_STORAGE_DIR from the home dir at import time
+    spawn_log = work_dir / "spawns.log"
+    os.environ.update({"STUB_XRAY_SPAWN_LOG": str(spawn_log), "STUB_XRAY_START_DELAY": str(args.xray_start_delay), "STUB_XRAY_FAIL_RATE": str(args.xray_fail_rate)})
+    os.chmod(STUB_XRAY, 0o755)
+    sys.path.insert(0, str(BENCH_DIR.parent))
+    import vpn_core as core
+    core.XRAY_PATH = STUB_XRAY
+
+    origin = socket.socket(); origin.bind(("127.0.0.1", 0)); origin.listen(4096) # "Alive" upstream: accepts, never answers
+    BenchHandler.subs = build_subscriptions(args.subs, args.servers, args.alive, origin.getsockname()[1], args.seed)
+    http.server.ThreadingHTTPServer.request_queue_size = 1024 # Default backlog of 5 drops SYNs when a batch of live servers probes at once
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BenchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    core.TEST_TARGET_URL = f"{base}/generate_204"
+    core.THROUGHPUT_URL = f"{base}/__down?bytes={args.payload_bytes}"
+
+    for run in range(1, args.runs + 1):
+        for f in (core.HEALTH_DB_FILE, spawn_log): Path(f).unlink(missing_ok=True)
+        res = asyncio.run(run_once(core, [f"{base}{p}" for p in BenchHandler.subs], args.throughput, not args.no_prescreen, args.workers))
+        rss_self, rss_child = peak_rss_kb()
+        res.update({"run": run, "subs": args.subs, "servers_per_sub": args.servers, "alive_ratio": args.alive,
+                    "xray_spawns": len(spawn_log.read_text().splitlines()) if spawn_log.exists() else 0,
+                    "peak_rss_kb": rss_self, "peak_child_rss_kb": rss_child})
+        if args.json: print(json.dumps(res, separators=(",", ":")))
+        else:
+            print(f"run {run}: {res['tested']} tested in {res['wall_s']}s ({res['tested_per_s']}/s), first result {res['first_result_s']}s, "
+                  f"alive {res['alive']}, screened out {res['screened_out']}, xray spawns {res['xray_spawns']}, peak RSS {rss_self // 1024} MiB (child {rss_child // 1024} MiB), "
+                  f"final concurrency {res['concurrency']}"
+                  + (f", throughput best {core.fmt_rate(res['throughput_best_bps'])} of {res['throughput_tested']}" if args.throughput else ""))
+    server.shutdown(); origin.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
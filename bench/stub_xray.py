@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Stand-in for the xray binary used by bench_update.py. Understands `run [-test] -c <file>` / `run -c stdin:` with the
+# configs vpn_core generates: every SOCKS inbound serves CONNECT by first dialing its routed outbound's
+# address:port (refused => SOCKS failure, i.e. a dead server) and then relaying to the requested destination.
+# Environment knobs:
+#   STUB_XRAY_START_DELAY  seconds before inbounds open (default 0.05)
+#   STUB_XRAY_FAIL_RATE    probability the process exits with an error on start (default 0)
+#   STUB_XRAY_SPAWN_LOG    file that gets one line appended per spawn
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import sys
+
+def outbound_target(ob: dict) -> tuple:
+    st = ob.get("settings", {})
+    for k in ("vnext", "servers"):
+        if st.get(k): return st[k][0].get("address"), int(st[k][0].get("port"))
+    return None, None
+
+async def pipe(reader, writer) -> None:
+    try:
+        while data := await reader.read(65536): writer.write(data); await writer.drain()
+    except Exception: pass
+    finally:
+        try: writer.close()
+        except Exception: pass
+
+def socks_handler(target: tuple):
+    async def handle(reader, writer) -> None:
+        try:
+            _, n_methods = await reader.readexactly(2); await reader.readexactly(n_methods)
+            writer.write(b"\x05\x00"); await writer.drain()
+            _, _, _, atyp = await reader.readexactly(4)
+            if atyp == 1: host = socket.inet_ntoa(await reader.readexactly(4))
+            elif atyp == 3: host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            else: host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+            port = struct.unpack("!H", await reader.readexactly(2))[0]
+            try:
+                _, probe_w = await asyncio.wait_for(asyncio.open_connection(*target), 3); probe_w.close()
+                up_r, up_w = await asyncio.open_connection(host, port)
+            except Exception:
+                writer.write(b"\x05\x05\x00\x01" + b"\0" * 6); await writer.drain(); writer.close(); return
+            writer.write(b"\x05\x00\x00\x01" + b"\0" * 6); await writer.drain()
+            await asyncio.gather(pipe(reader, up_w), pipe(up_r, writer))
+        except Exception:
+            writer.close()
+    return handle
+
+async def main() -> None:
+    args = sys.argv[1:]
+    flag = "-c" if "-c" in args else "-config"
+    cfg_path = args[args.index(flag) + 1]
+    cfg = json.loads(sys.stdin.read() if cfg_path.startswith("stdin:") else open(cfg_path).read())
+    if "-test" in args: print("Configuration OK.", file=sys.stderr); return # Config check only; not counted as a spawn
+    if spawn_log := os.environ.get("STUB_XRAY_SPAWN_LOG"):
+        with open(spawn_log, "a") as f: f.write(f"{os.getpid()}\n")
+    await asyncio.sleep(float(os.environ.get("STUB_XRAY_START_DELAY", "0.05")))
+    if random.random() < float(os.environ.get("STUB_XRAY_FAIL_RATE", "0")):
+        print("Failed to start: stub failure", file=sys.stderr); sys.exit(23)
+    outbounds = {ob.get("tag"): ob for ob in cfg["outbounds"]}
+    route = {tag: r["outboundTag"] for r in cfg.get("routing", {}).get("rules", []) for tag in r.get("inboundTag", [])}
+    servers = []
+    for ib in cfg["inbounds"]:
+        listen = ib.get("listen", "127.0.0.1")
+        if ib.get("protocol") != "socks": # e.g. the main config's HTTP inbound: just hold the port open
+            servers.append(await asyncio.start_server(lambda r, w: w.close(), listen, ib["port"])); continue
+        ob = outbounds.get(route.get(ib.get("tag"))) or cfg["outbounds"][0]
+        servers.append(await asyncio.start_server(socks_handler(outbound_target(ob)), listen, ib["port"]))
+    print("Xray stub started", file=sys.stderr, flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    try: asyncio.run(main())
+    except KeyboardInterrupt: pass
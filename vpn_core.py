@@ -0,0 +1,1854 @@
+import json
+import base64
+import subprocess
+import tempfile
+import os
+import time
+from pathlib import Path
+import asyncio
+import bisect
+import collections
+import contextlib
+import cProfile
+import platform # For checking architecture
+import zipfile  # For extracting zip files
+import re # For folding failure messages into metric reasons
+import signal
+import socket
+import sqlite3
+import ssl
+import hashlib
+import itertools
+import math
+import multiprocessing
+import zlib
+from urllib.parse import parse_qs, quote, unquote, urlencode, urljoin, urlsplit
+
+# --- Configuration ---
+SCRIPT_DIR = Path(__file__).resolve().parent
+XRAY_PATH = SCRIPT_DIR / "xray"
+
+CONFIG_STORAGE_DIR = Path.home() / ".v2ray_termux_client"
+SUBS_FILE = CONFIG_STORAGE_DIR / "subscriptions.json"
+SUBS_CACHE_FILE = CONFIG_STORAGE_DIR / "subscriptions_cache.json" # Per-URL ETag/Last-Modified, body hash and parsed servers
+LAST_SELECTED_CONFIG_FILE = CONFIG_STORAGE_DIR / "last_selected_xray_config.json"
+CURRENT_XRAY_PID_FILE = CONFIG_STORAGE_DIR / "xray.pid"
+HEALTH_DB_FILE = CONFIG_STORAGE_DIR / "server_health.sqlite3"
+LAST_RESULTS_FILE = CONFIG_STORAGE_DIR / "last_results.json" # Live servers of the last run, shown instantly on startup
+METRICS_JSON_FILE = CONFIG_STORAGE_DIR / "metrics.json"
+METRICS_PROM_FILE = CONFIG_STORAGE_DIR / "metrics.prom"
+PROFILE_FILE = CONFIG_STORAGE_DIR / "update_profile.pstats"
+LOG_FILE = CONFIG_STORAGE_DIR / "client.log" # Full, unfolded TUI log; rotated to client.log.1..N
+
+CONFIG_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+# Scratch dir for test configs when Xray can't read them from stdin: RAM-backed where there is one, never app storage first.
+TEST_SCRATCH_DIR = Path(next((d for d in ("/dev/shm", os.environ.get("TMPDIR"), "/tmp") if d and os.access(d, os.W_OK)), CONFIG_STORAGE_DIR))
+
+MAIN_SOCKS_PORT = 10808
+MAIN_HTTP_PORT = 10809
+
+# --- Application Information Constants ---
+APP_TITLE = "Termux V2Ray/Xray Client"
+APP_SUB_TITLE = "Manage & Auto-Test Connections"
+APP_VERSION = "0.5.0" # Final version from discussion
+DEVELOPER_NAME_CONST = "Developer Victor Geek"
+DEVELOPER_EMAIL_CONST = "frussel4@asu.edu"
+
+# --- Testing Configuration ---
+TEST_TARGET_URL = "http://www.gstatic.com/generate_204"
+TEST_SOCKS_PORT_BASE = 20800
+TEST_PORT_POOL_SIZE = 1000 # Test inbounds lease ports from [TEST_SOCKS_PORT_BASE, +TEST_PORT_POOL_SIZE)
+INITIAL_CONCURRENT_TESTS = 3 # Concurrent Xray test processes (each serves one batch); adapted at runtime...
+MIN_CONCURRENT_TESTS = 1
+MAX_CONCURRENT_TESTS = max(4, (os.cpu_count() or 2) * 2) # ...within these bounds
+TEST_LOAD_PER_CPU = 1.5 # No concurrency growth while loadavg exceeds this per core
+TEST_AIMD_COOLDOWN = 2.0 # Seconds between multiplicative decreases
+TEST_CONGESTION_MARKERS = ("ExTest:", "XrayTestNotReady", "Fail(Probe:handshake:") # Local overload, not a dead server
+TEST_BATCH_SIZE = 16 # Servers per Xray test process, one SOCKS inbound each
+TEST_BATCH_LINGER = 0.25 # Max wait for a partial batch to fill before testing it anyway
+TEST_WORKERS = 0 # >1: shard Xray batches across this many tester processes (own event loop + port range each); 0/1: test in-process
+TEST_WORKER_SETTINGS = ("XRAY_PATH", "TEST_TARGET_URL", "PROBE_SAMPLES", "PROBE_SAMPLE_TIMEOUT", "PROBE_CONNECT_TIMEOUT", "PROBE_TOTAL_TIMEOUT",
+                        "SCORE_WEIGHTS", "XRAY_READY_TIMEOUT", "XRAY_CONFIG_STDIN") # Module settings copied into each worker (it imports this module fresh)
+XRAY_CONFIG_STDIN: bool | None = None # Test configs go to Xray via `-c stdin:`; None = probe once with `run -test`, False = scratch files
+SUB_FETCH_CONNECT_TIMEOUT = 10
+SUB_FETCH_TOTAL_TIMEOUT = 30 # Subscriptions can be large
+SUB_MAX_LINE_BYTES = 1 << 20 # Longer lines / Clash proxy entries are dropped: bounds what the streaming decoder holds
+SUB_MAX_JSON_BYTES = 16 << 20 # SIP008 is a single JSON document, so it is buffered whole up to this size
+PROBE_CONNECT_TIMEOUT = 5 # SOCKS handshake + CONNECT through the test inbound
+PROBE_TOTAL_TIMEOUT = 10
+PROBE_SAMPLES = 4 # Timed requests per server on one warm keep-alive connection, after the first (cold) request
+PROBE_SAMPLE_TIMEOUT = 3 # Per timed request; a timeout counts as loss
+PRESCREEN_CONCURRENCY = 256 # Direct TCP/TLS checks in flight before the Xray stage; no process per check, so this can be high
+PRESCREEN_CONNECT_TIMEOUT = 3.0 # DNS + TCP connect to the server itself
+PRESCREEN_TLS_TIMEOUT = 4.0 # TLS handshake with the configured SNI (security "tls" only)
+PRESCREEN_UDP_NETWORKS = ("kcp", "mkcp", "quic") # UDP transports have no TCP listener to check: passed straight to Xray
+PRESCREEN_RECORD_CHUNK = 64 # Screened-out servers recorded to the health store per transaction
+DNS_CACHE_TTL = 300.0 # Resolved server hostnames are reused for this long...
+DNS_NEGATIVE_TTL = 60.0 # ...and failed lookups for this long
+SCORE_WEIGHTS = {"median": 1.0, "p90": 0.5, "jitter": 1.0, "loss": 1000.0} # Rank score = weighted ms stats + loss fraction * "loss"; lower is better
+THROUGHPUT_URL = "https://speed.cloudflare.com/__down?bytes=10000000" # Payload for the optional bandwidth stage
+THROUGHPUT_TOP_N = 5 # Best-scored servers that get a bandwidth test
+THROUGHPUT_MAX_BYTES = 10_000_000 # Stop a download after this many bytes...
+THROUGHPUT_MAX_SECS = 8.0 # ...or this long after the first byte
+THROUGHPUT_WARMUP_SECS = 0.5 # Bytes in the first moments after the first byte are left out of the sustained rate (slow start)
+XRAY_READY_TIMEOUT = 5.0 # Max wait for a spawned Xray to open its inbounds
+XRAY_READY_POLL_INTERVAL = 0.05
+XRAY_STOP_TIMEOUT = 2.0 # SIGTERM grace period before SIGKILL
+XRAY_RESTART_BASE_SECS = 1.0 # Crash restarts back off exponentially from this...
+XRAY_RESTART_MAX_SECS = 30.0 # ...up to this cap
+XRAY_STABLE_SECS = 30.0 # A run longer than this resets the backoff
+
+METRICS_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000) # Phase histogram upper bounds
+
+# --- Health Store Configuration ---
+HEALTH_EWMA_ALPHA = 0.3 # Weight of the newest latency sample in the EWMA score
+HEALTH_FRESH_SECS = 10 * 60 # Servers that passed within this window are reused, not retested
+HEALTH_BACKOFF_AFTER_FAILS = 3 # Consecutive failures before a server is backed off
+HEALTH_BACKOFF_BASE_SECS = 15 * 60 # Doubles per further failure...
+HEALTH_BACKOFF_MAX_SECS = 24 * 3600 # ...up to this cap
+HEALTH_HISTORY_LEN = 20 # Latency samples kept per server
+
+# --- Connection Watchdog Configuration ---
+WATCHDOG_INTERVAL = 5.0 # Seconds between probes of the live connection
+WATCHDOG_RETRY_INTERVAL = 1.0 # Re-probe delay once a probe has failed (confirms quickly instead of waiting a full interval)
+WATCHDOG_FAIL_THRESHOLD = 2 # Consecutive failed probes before failing over
+WATCHDOG_SLOW_MS = 2000 # A probe slower than this counts as degraded...
+WATCHDOG_SLOW_THRESHOLD = 3 # ...and this many degraded probes in a row also trigger failover
+WATCHDOG_STANDBY_K = 5 # Warm standbys kept from the last test
+
+# --- Logging Configuration ---
+LOG_FLUSH_INTERVAL = 0.25 # Buffered log lines reach the TUI at most this often
+LOG_MAX_LINES_PER_FLUSH = 200 # Older lines beyond this in one flush are skipped on screen (the file keeps them)
+LOG_WIDGET_MAX_LINES = 1000
+LOG_FILE_MAX_BYTES = 1 << 20 # LOG_FILE is rotated past this size...
+LOG_FILE_BACKUPS = 2 # ...keeping this many old files
+
+# --- Helper Functions ---
+def load_subscriptions():
+    if SUBS_FILE.exists():
+        try:
+            with open(SUBS_FILE, "r") as f: return json.load(f)
+        except json.JSONDecodeError: return []
+        return []
+
+def save_subscriptions(subs):
+    with open(SUBS_FILE, "w") as f: json.dump(subs, f, indent=2)
+
+def load_subs_cache() -> dict:
+    try:
+        with open(SUBS_CACHE_FILE, "r") as f: return json.load(f)
+    except (OSError, json.JSONDecodeError): return {}
+
+def save_subs_cache(cache: dict):
+    with open(SUBS_CACHE_FILE, "w") as f: json.dump(cache, f, separators=(",", ":"))
+
+LAST_RESULT_FIELDS = ("latency_ms", "score", "stats", "throughput")
+
+def save_last_results(results: list) -> None:
+    # Live results only; written to a temp file first so a crash mid-write keeps the previous snapshot.
+    data = {"saved": time.time(), "results": [{"config": r["config"].to_dict(), **{k: r.get(k) for k in LAST_RESULT_FIELDS}} for r in results if r.get("alive")]}
+    tmp = LAST_RESULTS_FILE.with_suffix(".tmp")
+    with open(tmp, "w") as f: json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, LAST_RESULTS_FILE)
+
+def load_last_results() -> list:
+    # Results from the last run, marked stale ("stale": True) until a new run confirms them.
+    try:
+        with open(LAST_RESULTS_FILE, "r") as f: data = json.load(f)
+    except (OSError, json.JSONDecodeError): return []
+    age_min, results = int((time.time() - data.get("saved", 0)) / 60), []
+    for item in data.get("results", []):
+        try: conf = ServerRecord.from_dict(item["config"])
+        except (KeyError, TypeError, ValueError): continue
+        results.append({"config": conf, "ps": conf.name, "alive": True, **{k: item.get(k) for k in LAST_RESULT_FIELDS},
+                        "message": f"last run ({age_min}m ago)", "timings": None, "cached": True, "stale": True})
+    return results
+
+# --- Metrics ---
+def failure_reason(message: str) -> str:
+    # Folds a test message into a bounded reason: "Fail(Probe:connect:SocksRep5)" -> "Probe:connect:SocksRep5",
+    # "XrayTestStartFail:name(RC:1)" -> "XrayTestStartFail", "ExTest:name:..." -> "ExTest".
+    if m := re.match(r"Fail\(([^)]*)\)", message or ""): return m.group(1)
+    return re.split(r"[:(]", message or "", maxsplit=1)[0] or "Unknown"
+
+class Metrics:
+    # Process-wide counters, failures by reason and per-phase latency histograms (ms) for the update/test path.
+    def __init__(self) -> None: self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.counters: collections.Counter = collections.Counter()
+        self.failures: collections.Counter = collections.Counter()
+        self.phases: dict = {} # phase -> {"buckets": per-bucket counts (+Inf last), "sum", "count", "max"}
+
+    def inc(self, name: str, n: int = 1) -> None: self.counters[name] += n
+
+    def observe(self, phase: str, ms: float) -> None:
+        h = self.phases.get(phase)
+        if h is None: h = self.phases[phase] = {"buckets": [0] * (len(METRICS_BUCKETS_MS) + 1), "sum": 0.0, "count": 0, "max": 0.0}
+        h["buckets"][bisect.bisect_left(METRICS_BUCKETS_MS, ms)] += 1
+        h["sum"] += ms; h["count"] += 1; h["max"] = max(h["max"], ms)
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(phase, (time.perf_counter() - t0) * 1000)
+
+    def record_failure(self, message: str) -> str:
+        reason = failure_reason(message); self.failures[reason] += 1
+        if reason.endswith(":Timeout") or reason == "XrayTestNotReady": self.counters["timeouts"] += 1
+        return reason
+
+    def quantile(self, phase: str, q: float) -> float | None:
+        # Upper bound of the bucket holding the q-quantile (the observed max for the +Inf bucket).
+        h = self.phases.get(phase)
+        if not h or not h["count"]: return None
+        target, seen = q * h["count"], 0
+        for i, n in enumerate(h["buckets"]):
+            seen += n
+            if seen >= target: return float(METRICS_BUCKETS_MS[i]) if i < len(METRICS_BUCKETS_MS) else h["max"]
+        return h["max"]
+
+    def snapshot(self) -> dict:
+        phases = {}
+        for phase, h in self.phases.items():
+            cum, acc = {}, 0
+            for le, n in zip([*map(str, METRICS_BUCKETS_MS), "+Inf"], h["buckets"]): acc += n; cum[le] = acc
+            phases[phase] = {"count": h["count"], "sum_ms": round(h["sum"], 3), "avg_ms": round(h["sum"] / h["count"], 3) if h["count"] else None,
+                             "max_ms": round(h["max"], 3), "p50_ms": self.quantile(phase, 0.5), "p90_ms": self.quantile(phase, 0.9), "buckets": cum}
+        return {"started": self.started, "uptime_s": round(time.time() - self.started, 3), "counters": dict(self.counters),
+                "failures": dict(self.failures.most_common()), "phases": phases}
+
+    def to_prometheus(self, prefix: str = "vpn_client") -> str:
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        snap, out = self.snapshot(), []
+        for name, n in sorted(snap["counters"].items()): out += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {n}"]
+        out.append(f"# TYPE {prefix}_failures_total counter")
+        out += [f'{prefix}_failures_total{{reason="{esc(r)}"}} {n}' for r, n in snap["failures"].items()]
+        out.append(f"# TYPE {prefix}_phase_duration_ms histogram")
+        for phase, h in sorted(snap["phases"].items()):
+            out += [f'{prefix}_phase_duration_ms_bucket{{phase="{esc(phase)}",le="{le}"}} {n}' for le, n in h["buckets"].items()]
+            out += [f'{prefix}_phase_duration_ms_sum{{phase="{esc(phase)}"}} {h["sum_ms"]}', f'{prefix}_phase_duration_ms_count{{phase="{esc(phase)}"}} {h["count"]}']
+        return "\n".join(out) + "\n"
+
+    def dump(self, path: Path | str) -> Path:
+        # Prometheus text for *.prom / *.txt, JSON otherwise.
+        path = Path(path)
+        text = self.to_prometheus() if path.suffix in (".prom", ".txt") else json.dumps(self.snapshot(), indent=2)
+        path.write_text(text); return path
+
+    def state(self) -> tuple[dict, dict, dict]: return dict(self.counters), dict(self.failures), self.phases
+
+    def merge(self, counters: dict, failures: dict, phases: dict) -> None:
+        # Folds in state() from another process (sharded tester workers send theirs with each batch).
+        self.counters.update(counters); self.failures.update(failures)
+        for phase, h in phases.items():
+            mine = self.phases.get(phase)
+            if mine is None: self.phases[phase] = {**h, "buckets": list(h["buckets"])}; continue
+            mine["buckets"] = [a + b for a, b in zip(mine["buckets"], h["buckets"])]
+            mine["sum"] += h["sum"]; mine["count"] += h["count"]; mine["max"] = max(mine["max"], h["max"])
+
+    def summary_lines(self) -> list[str]:
+        c, lines = self.counters, []
+        lines.append(f"Spawns {c['xray_spawns']} (start fail {c['xray_start_failures']}, not ready {c['xray_not_ready']}) | "
+                     f"Tested {c['tests']} alive {c['alive']} | Timeouts {c['timeouts']} | Subs {c['subs_fetched']} (304 {c['subs_not_modified']}, err {c['sub_fetch_errors']})")
+        for phase, h in sorted(self.phases.items(), key=lambda kv: -kv[1]["sum"]):
+            lines.append(f"{phase:<17} n={h['count']:<6} avg={h['sum'] / h['count']:8.1f}ms p50<={self.quantile(phase, 0.5):g} p90<={self.quantile(phase, 0.9):g} max={h['max']:.0f}ms")
+        if self.failures: lines.append("Failures: " + ", ".join(f"{r}={n}" for r, n in self.failures.most_common(6)))
+        return lines
+
+METRICS = Metrics()
+
+async def run_profiled(awaitable, out_path: Path | str):
+    # Opt-in cProfile around one awaited run (profiles everything on the loop meanwhile). View with `python -m pstats`.
+    prof = cProfile.Profile(); prof.enable()
+    try: return await awaitable
+    finally: prof.disable(); prof.dump_stats(str(out_path))
+
+# --- Log Buffer ---
+class LogBuffer:
+    # Decouples logging from a slow display (the TUI's Log widget): log() only appends, and flush(), run on a timer,
+    # returns the lines to show in one batch. Messages logged with a fold key (per-server test failures pass their
+    # failure reason) collapse to one "key (xN)" line per flush. Every message also goes, unfolded, to a size-rotated file.
+    def __init__(self, path: Path | None = LOG_FILE, max_bytes: int = LOG_FILE_MAX_BYTES, backups: int = LOG_FILE_BACKUPS,
+                 max_lines: int = LOG_MAX_LINES_PER_FLUSH) -> None:
+        self.path, self.max_bytes, self.backups, self.max_lines = path, max_bytes, backups, max_lines
+        self._lines: list = [] # Display lines, unfolded messages only
+        self._folded: dict = {} # fold key -> [count, last message, is_error]
+        self._file_lines: list = []
+
+    def log(self, message: str, is_error: bool = False, fold: str | None = None) -> None:
+        stamp = time.strftime("%H:%M:%S")
+        self._file_lines.append(f"{time.strftime('%Y-%m-%d')} {stamp} {'ERROR ' if is_error else ''}{message}\n")
+        if fold is None: self._lines.append(f"[{stamp}] {'ERROR: ' if is_error else ''}{message}"); return
+        entry = self._folded.setdefault(fold, [0, message, is_error]); entry[0] += 1; entry[1] = message
+
+    def flush(self) -> list:
+        stamp, lines = time.strftime("%H:%M:%S"), self._lines
+        for key, (n, last, is_error) in self._folded.items():
+            lines.append(f"[{stamp}] {'ERROR: ' if is_error else ''}{last if n == 1 else f'{key} (x{n})'}")
+        self._lines, self._folded = [], {}
+        if len(lines) > self.max_lines:
+            lines = [f"[{stamp}] ... {len(lines) - self.max_lines} lines skipped{f' (see {self.path})' if self.path else ''}"] + lines[-self.max_lines:]
+        self._write_file()
+        return lines
+
+    def _write_file(self) -> None:
+        text, self._file_lines = "".join(self._file_lines), []
+        if not text or self.path is None: return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f: f.write(text); size = f.tell()
+            if size > self.max_bytes: self._rotate()
+        except OSError: self.path = None # Storage gone or full: keep showing logs, stop writing them
+
+    def _rotate(self) -> None:
+        if self.backups <= 0: self.path.unlink(); return
+        for i in range(self.backups - 1, 0, -1):
+            if (old := self.path.with_name(f"{self.path.name}.{i}")).exists(): os.replace(old, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+# --- Server Records & Link Parsers ---
+class ServerRecord:
+    # Compact parsed server (no per-instance dict, no raw link kept). `key` is the canonical identity used for
+    # dedup and the health store: the same endpoint under a different label is the same server.
+    __slots__ = ("protocol", "name", "address", "port", "credential", "alter_id", "cipher", "flow", "network", "security",
+                 "sni", "host", "path", "header_type", "fp", "alpn", "pbk", "sid", "spx", "allow_insecure")
+
+    def __init__(self, protocol: str, address: str, port: int, credential: str, name: str = "", alter_id: int = 0, cipher: str = "",
+                 flow: str = "", network: str = "tcp", security: str = "none", sni: str = "", host: str = "", path: str = "",
+                 header_type: str = "", fp: str = "", alpn: str = "", pbk: str = "", sid: str = "", spx: str = "", allow_insecure: bool = False) -> None:
+        self.protocol, self.address, self.port, self.credential = protocol, address, int(port), credential
+        self.name = name.strip() or f"{address}:{port}"
+        self.alter_id, self.cipher, self.flow = int(alter_id or 0), cipher, flow
+        self.network, self.security = (network or "tcp").lower(), (security or "none").lower()
+        self.sni, self.host, self.path, self.header_type = sni, host, path, header_type
+        self.fp, self.alpn, self.pbk, self.sid, self.spx, self.allow_insecure = fp, alpn, pbk, sid, spx, bool(allow_insecure)
+
+    @property
+    def key(self) -> str:
+        transport = f"{self.network}/{self.security}/{self.host}/{self.path}"
+        return "|".join((self.protocol, self.address.lower(), str(self.port), self.cipher, self.credential, transport))
+
+    def __repr__(self) -> str: return f"ServerRecord({self.protocol}://{self.address}:{self.port} {self.name!r})"
+
+    def to_dict(self) -> dict: return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "ServerRecord": return cls(**{k: d[k] for k in cls.__slots__ if k in d})
+
+def _b64decode_loose(data: str) -> bytes:
+    # Accepts standard or URL-safe alphabets with or without padding.
+    data = data.strip().replace("-", "+").replace("_", "/")
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+def parse_vmess_link(vmess_link: str) -> ServerRecord | None:
+    if not vmess_link.startswith("vmess://"): return None
+    try:
+        c = json.loads(_b64decode_loose(vmess_link[8:]).decode("utf-8"))
+        add, host = str(c.get('add', '')), str(c.get('host', ''))
+        if not add: return None
+        return ServerRecord("vmess", add, int(c.get('port', 443)), str(c.get('id', '')), name=str(c.get('ps', '')), alter_id=int(c.get('aid', 0) or 0),
+                            cipher=str(c.get('scy', '') or 'auto'), network=str(c.get('net', 'tcp')), security=str(c.get('tls', '') or 'none'),
+                            sni=str(c.get('sni', '') or host or add), host=host, path=str(c.get('path', '/')), header_type=str(c.get('type', '') or ''),
+                            fp=str(c.get('fp', '')), alpn=str(c.get('alpn', '')), allow_insecure=c.get('allowInsecure') in (True, 1, "1", "true"))
+    except Exception:
+        return None
+
+def _parse_url_link(link: str, protocol: str, default_security: str) -> ServerRecord | None:
+    # Shared parser for the URI-style vless:// and trojan:// formats (userinfo@host:port?params#name).
+    try:
+        u = urlsplit(link)
+        q = {k: v[-1] for k, v in parse_qs(u.query).items()}
+        if not u.hostname or not u.username: return None
+        network = q.get("type", "tcp")
+        host = q.get("host", "")
+        path = q.get("serviceName", "") if network == "grpc" else q.get("path", "/")
+        return ServerRecord(protocol, u.hostname, u.port or 443, unquote(u.username), name=unquote(u.fragment), flow=q.get("flow", ""),
+                            network=network, security=q.get("security", default_security), sni=q.get("sni", q.get("peer", "")) or host or u.hostname,
+                            host=host, path=path, header_type=q.get("headerType", ""), fp=q.get("fp", ""), alpn=q.get("alpn", ""),
+                            pbk=q.get("pbk", ""), sid=q.get("sid", ""), spx=q.get("spx", ""), allow_insecure=q.get("allowInsecure", "0") in ("1", "true"))
+    except (ValueError, TypeError):
+        return None
+
+def parse_vless_link(link: str) -> ServerRecord | None: return _parse_url_link(link, "vless", "none")
+def parse_trojan_link(link: str) -> ServerRecord | None: return _parse_url_link(link, "trojan", "tls")
+
+def parse_ss_link(link: str) -> ServerRecord | None:
+    # SIP002 (ss://b64(method:pass)@host:port#name) and legacy (ss://b64(method:pass@host:port)#name). Plugins unsupported.
+    try:
+        body, _, name = link[5:].partition("#")
+        body, _, query = body.partition("?")
+        if "plugin=" in query: return None
+        if "@" in body:
+            userinfo, _, hostport = body.rpartition("@")
+            userinfo = unquote(userinfo)
+            if ":" not in userinfo: userinfo = _b64decode_loose(userinfo).decode("utf-8")
+        else:
+            userinfo, _, hostport = _b64decode_loose(body).decode("utf-8").rpartition("@")
+        method, _, password = userinfo.partition(":")
+        host, _, port = hostport.rpartition(":")
+        if not (method and password and host and port): return None
+        return ServerRecord("shadowsocks", host.strip("[]"), int(port.rstrip("/")), password, name=unquote(name), cipher=method.lower())
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+LINK_PARSERS = {"vmess": parse_vmess_link, "vless": parse_vless_link, "trojan": parse_trojan_link, "ss": parse_ss_link}
+
+def parse_link(link: str) -> ServerRecord | None:
+    scheme, sep, _ = link.strip().partition("://")
+    parser = LINK_PARSERS.get(scheme.lower()) if sep else None
+    return parser(link.strip()) if parser else None
+
+# --- Subscription Decoding ---
+_B64_URLSAFE = bytes.maketrans(b"-_", b"+/")
+_LINK_START = re.compile(rb"[A-Za-z][A-Za-z0-9+.-]*://")
+_YAML_KEY_LINE = re.compile(rb"(---|[\w.-]+\s*:(\s|$))")
+
+def _b64_block(data: bytes) -> bytes:
+    data = data[:len(data) - 1] if len(data) % 4 == 1 else data # A lone trailing char carries no full byte
+    try: return base64.b64decode(data + b"=" * (-len(data) % 4))
+    except ValueError: return b""
+
+def _yaml_scalar(v: str):
+    if v[:1] in ("'", '"'):
+        q = v[0]; end = v.rfind(q)
+        v = v[1:end] if end > 0 else v[1:]
+        return v.replace("''", "'") if q == "'" else v.replace('\\"', '"')
+    v = v.split(" #", 1)[0].strip()
+    if v in ("true", "True"): return True
+    if v in ("false", "False"): return False
+    if v in ("null", "~", ""): return None
+    return int(v) if re.fullmatch(r"-?\d+", v) else v
+
+def _yaml_flow(s: str, i: int = 0):
+    # Flow collections ({a: b, c: [d, e]}) as used in one-line Clash proxies. Returns (value, next_index).
+    while i < len(s) and s[i] == " ": i += 1
+    if i < len(s) and s[i] in "{[":
+        is_map, out, i = s[i] == "{", ({} if s[i] == "{" else []), i + 1
+        while i < len(s):
+            while i < len(s) and s[i] in " ,": i += 1
+            if i < len(s) and s[i] in "}]": return out, i + 1
+            if is_map:
+                m = re.compile(r"\s*('[^']*'|\"[^\"]*\"|[^:,{}\[\]]+?)\s*:\s*").match(s, i)
+                if not m: return out, len(s)
+                val, i = _yaml_flow(s, m.end()); out[m.group(1).strip("'\"")] = val
+            else: val, i = _yaml_flow(s, i); out.append(val)
+        return out, i
+    m = re.compile(r"'[^']*'|\"(?:[^\"\\]|\\.)*\"|[^,{}\[\]]*").match(s, i)
+    return _yaml_scalar(m.group(0).strip()), m.end()
+
+def _yaml_value(v: str): return _yaml_flow(v)[0] if v[:1] in ("{", "[") else _yaml_scalar(v)
+
+def _yaml_block(lines: list) -> dict:
+    # Block mapping of one Clash proxy entry (first line's "- " already blanked). Nested maps and "- x" lists only.
+    root: dict = {}
+    stack: list = [(-1, root)] # (indent, dict | list | [parent, key] slot awaiting its first child)
+    for text in lines:
+        body, indent = text.strip(), len(text) - len(text.lstrip())
+        if not body or body.startswith("#"): continue
+        is_item = body == "-" or body.startswith("- ")
+        while len(stack) > 1 and (indent < stack[-1][0] or indent == stack[-1][0] and not (is_item and isinstance(stack[-1][1], tuple))): stack.pop()
+        if isinstance(slot := stack[-1][1], tuple): # First child decides list vs map
+            parent, key = slot; new = parent[key] = [] if is_item else {}; stack[-1] = (stack[-1][0], new)
+        container = stack[-1][1]
+        if is_item:
+            if isinstance(container, list): container.append(_yaml_value(body[1:].strip()))
+            continue
+        key, sep, val = body.partition(":")
+        if not sep or not isinstance(container, dict): continue
+        key, val = key.strip().strip("'\""), val.strip()
+        if val and not val.startswith("#"): container[key] = _yaml_value(val)
+        else: container[key] = None; stack.append((indent, (container, key)))
+    return root
+
+def _ss_link(server, port, method, password, name) -> str | None:
+    if not (server and port and method and password): return None
+    userinfo = base64.urlsafe_b64encode(f"{method}:{password}".encode()).decode().rstrip("=")
+    return f"ss://{userinfo}@{f'[{server}]' if ':' in str(server) else server}:{port}#{quote(str(name or ''))}"
+
+def clash_proxy_to_link(p: dict) -> str | None:
+    # One Clash/Mihomo "proxies" entry -> the equivalent share link (vmess, vless, trojan, ss without plugin).
+    try:
+        kind, server, port, name = str(p.get("type", "")).lower(), p.get("server"), p.get("port"), str(p.get("name", ""))
+        if not server or not port: return None
+        if kind == "ss": return None if p.get("plugin") else _ss_link(server, port, p.get("cipher"), p.get("password"), name)
+        net, header_type = str(p.get("network") or "tcp"), ""
+        ws, grpc, h2, http_o = (p.get(k) or {} for k in ("ws-opts", "grpc-opts", "h2-opts", "http-opts"))
+        if net == "http": net, header_type = "tcp", "http" # Clash "http" network = HTTP header obfuscation over TCP
+        first = lambda v: (v[0] if v else "") if isinstance(v, list) else (v or "")
+        host = (ws.get("headers") or {}).get("Host") or first(h2.get("host")) or first((http_o.get("headers") or {}).get("Host"))
+        path = ws.get("path") or h2.get("path") or grpc.get("grpc-service-name") or first(http_o.get("path"))
+        reality = p.get("reality-opts") or {}
+        security = "reality" if reality else "tls" if p.get("tls") or kind == "trojan" else "none"
+        sni, fp, alpn = p.get("servername") or p.get("sni") or "", p.get("client-fingerprint") or "", p.get("alpn") or ""
+        alpn = ",".join(alpn) if isinstance(alpn, list) else str(alpn)
+        if kind == "vmess":
+            conf = {"v": "2", "ps": name, "add": server, "port": port, "id": p.get("uuid", ""), "aid": p.get("alterId", 0), "scy": p.get("cipher") or "auto",
+                    "net": net, "type": header_type, "host": host, "path": path or "", "tls": "tls" if security == "tls" else "", "sni": sni, "fp": fp,
+                    "alpn": alpn, "allowInsecure": bool(p.get("skip-cert-verify"))}
+            return "vmess://" + base64.b64encode(json.dumps(conf, separators=(",", ":")).encode()).decode()
+        if kind not in ("vless", "trojan"): return None
+        params = {"type": net, "security": security, "sni": sni, "fp": fp, "alpn": alpn, "flow": p.get("flow") or "", "host": host, "headerType": header_type,
+                  ("serviceName" if net == "grpc" else "path"): path or "", "pbk": reality.get("public-key") or "", "sid": reality.get("short-id") or "",
+                  "allowInsecure": "1" if p.get("skip-cert-verify") else ""}
+        cred = p.get("uuid") if kind == "vless" else p.get("password")
+        if not cred: return None
+        query = urlencode({k: v for k, v in params.items() if v}, quote_via=quote)
+        return f"{kind}://{quote(str(cred), safe='')}@{f'[{server}]' if ':' in str(server) else server}:{port}?{query}#{quote(name)}"
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class SubscriptionDecoder:
+    # Incremental subscription decoder: feed() body chunks as they arrive and iterate the links completed so far,
+    # then close(). The format is sniffed from the first line: a share-link list, base64 of one (standard or URL-safe,
+    # padded or not, line-wrapped or several padded blocks back to back), Clash YAML ("proxies:") or SIP008 JSON.
+    # Between chunks only a partial line, base64 quantum or Clash entry is held (each capped at SUB_MAX_LINE_BYTES);
+    # SIP008, being one JSON document, is buffered whole.
+    def __init__(self) -> None:
+        self.format: str | None = None # "links" | "base64" | "clash" | "sip008"
+        self._head, self._b64, self._json = b"", b"", bytearray()
+        self._line, self._skip_line = bytearray(), False
+        self._in_proxies, self._item, self._item_indent, self._item_size = False, None, 0, 0
+
+    def feed(self, data: bytes):
+        if self.format is None:
+            self._head += data
+            if not self._sniff(final=False): return
+            data, self._head = self._head, b""
+        yield from self._dispatch(data, final=False)
+
+    def close(self):
+        if self.format is None:
+            if not self._sniff(final=True): return
+            data, self._head = self._head, b""
+        else: data = b""
+        yield from self._dispatch(data, final=True)
+
+    def _sniff(self, final: bool) -> bool:
+        # Decides on the first line that is not blank or a comment.
+        for line in self._head.lstrip(b"\xef\xbb\xbf").splitlines(keepends=True):
+            body = line.strip()
+            if not body or body.startswith(b"#"): continue
+            if not line.endswith(b"\n") and not final and len(body) < 256: return False # Wait for more of the line
+            if body[:1] == b"{": self.format = "sip008"
+            elif _LINK_START.match(body): self.format = "links"
+            elif _YAML_KEY_LINE.match(body) or body[:2] == b"- ": self.format = "clash"
+            else: self.format = "base64"
+            return True
+        if final or len(self._head) > SUB_MAX_LINE_BYTES: self.format = "links"; return True # Only comments/blank: nothing to decode
+        return False
+
+    def _dispatch(self, data: bytes, final: bool):
+        if self.format == "sip008":
+            self._json += data
+            if len(self._json) > SUB_MAX_JSON_BYTES: self._json.clear(); self.format = "links"; return # Give up on an oversized document
+            if final: yield from self._sip008()
+        elif self.format == "clash":
+            for line in self._lines(data, final): yield from self._clash_line(line.decode("utf-8", "ignore"))
+            if final: yield from self._clash_item_done()
+        else:
+            if self.format == "base64": data = self._b64_feed(data, final)
+            for line in self._lines(data, final):
+                if _LINK_START.match(line := line.strip()): yield line.decode("utf-8", "ignore")
+
+    def _lines(self, data: bytes, final: bool):
+        self._line += data
+        start = 0
+        while (nl := self._line.find(b"\n", start)) >= 0:
+            if self._skip_line: self._skip_line = False
+            elif nl - start <= SUB_MAX_LINE_BYTES: yield bytes(self._line[start:nl])
+            start = nl + 1
+        del self._line[:start]
+        if len(self._line) > SUB_MAX_LINE_BYTES: self._line.clear(); self._skip_line = True # Drop the rest of this line too
+        if final:
+            if self._line and not self._skip_line: yield bytes(self._line)
+            self._line.clear()
+
+    def _b64_feed(self, data: bytes, final: bool) -> bytes:
+        buf, out = self._b64 + data.translate(_B64_URLSAFE, b" \t\r\n"), []
+        while (eq := buf.find(b"=")) >= 0: # Padding ends a block; a new one may follow
+            end = eq
+            while end < len(buf) and buf[end] == 61: end += 1 # "="
+            out.append(_b64_block(buf[:eq])); buf = buf[end:]
+        cut = len(buf) if final else len(buf) - len(buf) % 4
+        out.append(_b64_block(buf[:cut])); self._b64 = buf[cut:]
+        return b"".join(out)
+
+    def _clash_line(self, text: str):
+        body = text.strip()
+        if not body or body.startswith("#"): return
+        indent = len(text) - len(text.lstrip())
+        if indent == 0 and not body.startswith("-"): # Top-level key
+            yield from self._clash_item_done(); self._in_proxies = body.split(":", 1)[0].strip() == "proxies"; return
+        if not self._in_proxies: return
+        if body.startswith("-") and (self._item is None or indent <= self._item_indent):
+            yield from self._clash_item_done()
+            self._item, self._item_indent, self._item_size = [text], indent, len(text); return
+        if self._item is not None:
+            self._item_size += len(text)
+            if self._item_size > SUB_MAX_LINE_BYTES: self._item = None # Runaway entry: drop it
+            else: self._item.append(text)
+
+    def _clash_item_done(self):
+        item, self._item = self._item, None
+        if not item: return
+        first = item[0].replace("-", " ", 1)
+        proxy = _yaml_flow(" ".join(t.strip() for t in item)[1:].strip())[0] if first.lstrip().startswith("{") else _yaml_block([first] + item[1:])
+        if isinstance(proxy, dict) and (link := clash_proxy_to_link(proxy)): yield link
+
+    def _sip008(self):
+        try: doc = json.loads(bytes(self._json))
+        except ValueError: return
+        finally: self._json.clear()
+        for srv in doc.get("servers", []) if isinstance(doc, dict) else []:
+            if isinstance(srv, dict) and not srv.get("plugin"):
+                if link := _ss_link(srv.get("server"), srv.get("server_port"), srv.get("method"), srv.get("password"), srv.get("remarks")): yield link
+
+def decode_subscription(body: bytes | str) -> list:
+    # Whole-body convenience wrapper around SubscriptionDecoder.
+    dec = SubscriptionDecoder()
+    return [*dec.feed(body.encode() if isinstance(body, str) else body), *dec.close()]
+
+# --- Xray Config Builders ---
+def _vmess_settings(s: ServerRecord) -> dict:
+    return {"vnext": [{"address": s.address, "port": s.port, "users": [{"id": s.credential, "alterId": s.alter_id, "security": s.cipher or "auto"}]}]}
+
+def _vless_settings(s: ServerRecord) -> dict:
+    user = {"id": s.credential, "encryption": "none"}
+    if s.flow: user["flow"] = s.flow
+    return {"vnext": [{"address": s.address, "port": s.port, "users": [user]}]}
+
+def _trojan_settings(s: ServerRecord) -> dict: return {"servers": [{"address": s.address, "port": s.port, "password": s.credential}]}
+def _shadowsocks_settings(s: ServerRecord) -> dict: return {"servers": [{"address": s.address, "port": s.port, "method": s.cipher, "password": s.credential}]}
+
+OUTBOUND_SETTINGS_BUILDERS = {"vmess": _vmess_settings, "vless": _vless_settings, "trojan": _trojan_settings, "shadowsocks": _shadowsocks_settings}
+
+def build_stream_settings(s: ServerRecord) -> dict:
+    host_header = s.host or s.address
+    net = {"h2": "http"}.get(s.network, s.network)
+    stream = {"network": net, "security": s.security if s.security in ("tls", "reality") else "none"}
+    if net == "ws":
+        stream["wsSettings"] = {"path": s.path or "/", "headers": {"Host": host_header}}
+    elif net == "grpc":
+        stream["grpcSettings"] = {"serviceName": s.path.lstrip("/")}
+    elif net == "http":
+        stream["httpSettings"] = {"path": s.path or "/", "host": [host_header]}
+    elif net == "httpupgrade":
+        stream["httpupgradeSettings"] = {"path": s.path or "/", "host": host_header}
+    elif net == "tcp" and s.header_type == "http":
+        stream["tcpSettings"] = {"header": {"type": "http", "request": {"path": [s.path or "/"], "headers": {"Host": [host_header]}}}}
+    if s.security == "tls":
+        stream["tlsSettings"] = {"serverName": s.sni or host_header, "allowInsecure": s.allow_insecure}
+        if s.fp: stream["tlsSettings"]["fingerprint"] = s.fp
+        if s.alpn: stream["tlsSettings"]["alpn"] = s.alpn.split(",")
+    elif s.security == "reality":
+        stream["realitySettings"] = {"serverName": s.sni, "fingerprint": s.fp or "chrome", "publicKey": s.pbk, "shortId": s.sid, "spiderX": s.spx}
+    return stream
+
+def build_xray_outbound(server_config: ServerRecord, tag: str | None = None) -> dict:
+    xray_outbound = {"protocol": server_config.protocol, "settings": OUTBOUND_SETTINGS_BUILDERS[server_config.protocol](server_config)}
+    if server_config.protocol != "shadowsocks": xray_outbound["streamSettings"] = build_stream_settings(server_config)
+    if tag: xray_outbound["tag"] = tag
+    return xray_outbound
+
+def generate_xray_config(server_config: ServerRecord, local_socks_port: int = MAIN_SOCKS_PORT, local_http_port: int = MAIN_HTTP_PORT) -> dict | None:
+    if not server_config:
+        return None
+    try:
+        return {
+            "log": {"loglevel": "warning", "access": "none"}, # Streamed into the app log by XraySupervisor
+            "inbounds": [
+                {"port": local_socks_port, "listen": "127.0.0.1", "protocol": "socks", "settings": {"auth": "noauth", "udp": False, "ip": "127.0.0.1"}},
+                {"port": local_http_port, "listen": "127.0.0.1", "protocol": "http", "settings": {}}
+            ],
+            "outbounds": [build_xray_outbound(server_config), {"protocol": "freedom", "tag": "direct"}],
+            "routing": {"rules": [{"type": "field", "ip": ["geoip:private"], "outboundTag": "direct"}]}
+        }
+    except Exception:
+        return None
+
+# Batch config template, pre-serialized: only the per-server outbounds are built (and json-encoded) per batch.
+# No geoip rule here: test targets are public and geoip.dat may not sit next to xray.
+_BATCH_INBOUND = '{"tag":"in%d","port":%d,"listen":"127.0.0.1","protocol":"socks","settings":{"auth":"noauth","udp":false}}'
+_BATCH_RULE = '{"type":"field","inboundTag":["in%d"],"outboundTag":"out%d"}'
+_BATCH_TEMPLATE = '{"log":{"loglevel":"none"},"inbounds":[%s],"outbounds":[%s],"routing":{"rules":[%s]}}'
+_compact_json = json.JSONEncoder(separators=(",", ":"), check_circular=False).encode
+
+def generate_batch_xray_config(server_configs: list, socks_ports: list) -> bytes | None:
+    # One Xray process for many servers: SOCKS inbound "in<i>" on socks_ports[i] is routed to outbound "out<i>".
+    # Returns the config as compact JSON bytes, ready for Xray's stdin.
+    if not server_configs or len(server_configs) != len(socks_ports):
+        return None
+    try:
+        n = range(len(server_configs))
+        outbounds = ",".join('{"tag":"out%d",%s' % (i, _compact_json(build_xray_outbound(s))[1:]) for i, s in zip(n, server_configs))
+        return (_BATCH_TEMPLATE % (",".join(_BATCH_INBOUND % (i, p) for i, p in zip(n, socks_ports)), outbounds,
+                                   ",".join(_BATCH_RULE % (i, i) for i in n))).encode()
+    except Exception:
+        return None
+
+class ProbeError(Exception):
+    def __init__(self, phase: str, detail: str) -> None: super().__init__(f"{phase}:{detail}"); self.phase = phase; self.detail = detail
+
+async def read_http_head(reader: asyncio.StreamReader, first: bytes = b"") -> tuple[int, dict]:
+    # Reads a status line + headers (up to the blank line). Returns (status_code, {lower-name: value}).
+    head = first + await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit(): raise ValueError(f"Bad status line: {lines[0][:40]}")
+    headers = {}
+    for ln in lines[1:]:
+        if ":" in ln: k, v = ln.split(":", 1); headers[k.strip().lower()] = v.strip()
+    return int(parts[1]), headers
+
+async def socks5_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, port: int) -> tuple[float, float]:
+    # No-auth SOCKS5 CONNECT by domain name (remote DNS, like socks5h). Returns (handshake_ms, connect_ms).
+    t0 = time.perf_counter()
+    writer.write(b"\x05\x01\x00"); await writer.drain()
+    ver, method = await reader.readexactly(2)
+    if ver != 5 or method != 0: raise ProbeError("handshake", f"Method{method}")
+    t1 = time.perf_counter()
+    h = host.encode("idna")
+    writer.write(b"\x05\x01\x00\x03" + bytes([len(h)]) + h + port.to_bytes(2, "big")); await writer.drain()
+    _, rep, _, atyp = await reader.readexactly(4)
+    if rep != 0: raise ProbeError("connect", f"SocksRep{rep}")
+    await reader.readexactly({1: 4, 4: 16}.get(atyp) or (await reader.readexactly(1))[0]); await reader.readexactly(2) # Bound addr + port
+    return (t1 - t0) * 1000, (time.perf_counter() - t1) * 1000
+
+async def _http_exchange(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, u, keep_alive: bool, on_first_byte=None) -> tuple[float, int, bool]:
+    # One GET on an open connection. Returns (ttfb_ms, status, reusable); with keep_alive the body is drained so
+    # the connection can carry the next request. on_first_byte() runs once the response starts.
+    t_req = time.perf_counter()
+    writer.write(f"GET {u.path or '/'}{'?' + u.query if u.query else ''} HTTP/1.1\r\nHost: {u.netloc}\r\nUser-Agent: {APP_TITLE}/{APP_VERSION}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()); await writer.drain()
+    first = await reader.readexactly(1)
+    ttfb = (time.perf_counter() - t_req) * 1000
+    if on_first_byte: on_first_byte()
+    status, headers = await read_http_head(reader, first)
+    if not keep_alive or headers.get("connection", "").lower() == "close": return ttfb, status, False
+    if not (status in (204, 304) or 100 <= status < 200):
+        if "content-length" not in headers and "chunked" not in headers.get("transfer-encoding", "").lower(): return ttfb, status, False # Read-until-close body
+        async for _ in iter_http_body(reader, headers): pass
+    return ttfb, status, True
+
+async def socks5_http_probe(socks_port: int, url: str | None = None, socks_host: str = "127.0.0.1", samples: int = 0) -> dict:
+    # In-process replacement for `curl --proxy socks5h://...`. Timings in ms: handshake (greeting with the local
+    # inbound), connect (CONNECT reply; Xray may ack before dialing, so upstream dial can land in ttfb), ttfb
+    # (request sent -> first response byte) and total. Raises ProbeError naming the phase that failed.
+    # With samples > 0 the connection is kept alive and that many more GETs are timed on it (request -> full
+    # response): "samples" holds the ms of each that completed and "lost" counts the rest (a timeout or broken
+    # connection loses every remaining sample). A server that closes after the first response yields no samples.
+    u = urlsplit(url or TEST_TARGET_URL)
+    host, port = u.hostname or "", u.port or (443 if u.scheme == "https" else 80)
+    conn, phase, t_start = [], "handshake", time.perf_counter()
+
+    async def _open() -> tuple[float, float]:
+        reader, writer = await asyncio.open_connection(socks_host, socks_port); conn.extend((reader, writer))
+        timings = await socks5_connect(reader, writer, host, port)
+        if u.scheme == "https": await writer.start_tls(ssl.create_default_context(), server_hostname=host)
+        return timings
+
+    def _got_first_byte() -> None:
+        nonlocal phase
+        phase = "response"
+
+    async def _sample(reader, writer) -> tuple[float, bool]:
+        t0 = time.perf_counter()
+        _, _, reusable = await _http_exchange(reader, writer, u, True)
+        return (time.perf_counter() - t0) * 1000, reusable
+
+    try:
+        handshake_ms, connect_ms = await asyncio.wait_for(_open(), PROBE_CONNECT_TIMEOUT)
+        phase = "ttfb"
+        ttfb_ms, status, reusable = await asyncio.wait_for(_http_exchange(*conn, u, samples > 0, _got_first_byte), max(0.1, PROBE_TOTAL_TIMEOUT - (time.perf_counter() - t_start)))
+        total_ms = (time.perf_counter() - t_start) * 1000
+        timed, lost = [], 0
+        if samples > 0 and reusable:
+            for i in range(samples):
+                try: ms, reusable = await asyncio.wait_for(_sample(*conn), PROBE_SAMPLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ValueError): lost = samples - i; break
+                timed.append(ms)
+                if not reusable: break
+    except ProbeError: raise
+    except asyncio.TimeoutError: raise ProbeError(phase, "Timeout")
+    except asyncio.IncompleteReadError: raise ProbeError(phase, "Closed")
+    except (OSError, ValueError, asyncio.LimitOverrunError) as e: raise ProbeError(phase, type(e).__name__)
+    finally:
+        if conn:
+            conn[1].close()
+            try: await conn[1].wait_closed()
+            except Exception: pass
+    res = {"handshake_ms": handshake_ms, "connect_ms": connect_ms, "ttfb_ms": ttfb_ms, "total_ms": total_ms, "status": status}
+    if samples > 0: res.update(samples=timed, lost=lost)
+    return res
+
+def latency_stats(samples: list, lost: int = 0) -> dict:
+    # Median, nearest-rank p90, jitter (mean |delta| of consecutive samples, RFC 3550 style) and loss fraction.
+    ok, n = sorted(samples), len(samples)
+    if not n: return {"median_ms": None, "p90_ms": None, "jitter_ms": None, "loss": 1.0 if lost else 0.0, "samples": lost}
+    median = ok[n // 2] if n % 2 else (ok[n // 2 - 1] + ok[n // 2]) / 2
+    jitter = sum(abs(a - b) for a, b in zip(samples, samples[1:])) / (n - 1) if n > 1 else 0.0
+    return {"median_ms": median, "p90_ms": ok[max(0, math.ceil(0.9 * n) - 1)], "jitter_ms": jitter, "loss": lost / (n + lost), "samples": n + lost}
+
+def composite_score(stats: dict, weights: dict | None = None) -> float:
+    w = weights or SCORE_WEIGHTS
+    return w["median"] * stats["median_ms"] + w["p90"] * stats["p90_ms"] + w["jitter"] * stats["jitter_ms"] + w["loss"] * stats["loss"]
+
+def rank_key(res: dict) -> float:
+    # Sort key for live servers: composite score, falling back to plain latency for results without one.
+    v = res.get("score")
+    if v is None: v = res.get("latency_ms")
+    return float("inf") if v is None else v
+
+def throughput_rank_key(res: dict) -> tuple:
+    # Bandwidth-tested servers first (fastest sustained rate first), then everything else by rank_key.
+    bps = (res.get("throughput") or {}).get("bytes_per_sec")
+    return (0, -bps) if bps else (1, rank_key(res))
+
+def fmt_rate(bytes_per_sec: float | None) -> str:
+    if not bytes_per_sec: return "-"
+    return f"{bytes_per_sec / 1e6:.2f} MB/s" if bytes_per_sec >= 1e6 else f"{bytes_per_sec / 1e3:.0f} kB/s"
+
+async def socks5_http_download(socks_port: int, url: str | None = None, max_bytes: int = THROUGHPUT_MAX_BYTES, max_secs: float = THROUGHPUT_MAX_SECS) -> dict:
+    # Downloads url through a SOCKS inbound until max_bytes, max_secs after the first byte, or the end of the body.
+    # Returns {"ttfb_ms", "bytes", "secs", "bytes_per_sec", "status"}; bytes_per_sec is the sustained rate after
+    # THROUGHPUT_WARMUP_SECS (or since the first byte for shorter transfers). Raises ProbeError like socks5_http_probe.
+    u = urlsplit(url or THROUGHPUT_URL)
+    host, port = u.hostname or "", u.port or (443 if u.scheme == "https" else 80)
+    conn, phase = [], "handshake"
+
+    async def _open() -> None:
+        reader, writer = await asyncio.open_connection("127.0.0.1", socks_port); conn.extend((reader, writer))
+        await socks5_connect(reader, writer, host, port)
+        if u.scheme == "https": await writer.start_tls(ssl.create_default_context(), server_hostname=host)
+
+    async def _download() -> dict:
+        nonlocal phase
+        reader, writer = conn
+        t_req = time.perf_counter()
+        writer.write(f"GET {u.path or '/'}{'?' + u.query if u.query else ''} HTTP/1.1\r\nHost: {u.netloc}\r\nUser-Agent: {APP_TITLE}/{APP_VERSION}\r\n"
+                     "Accept-Encoding: identity\r\nConnection: close\r\n\r\n".encode()); await writer.drain()
+        first = await reader.readexactly(1)
+        t_first = time.perf_counter()
+        phase = "response"; status, headers = await read_http_head(reader, first)
+        if status != 200: raise ProbeError("response", f"HTTP{status}")
+        phase = "body"
+        got, warm_at, warm_bytes = 0, None, 0
+        async for chunk in iter_http_body(reader, headers):
+            got += len(chunk); now = time.perf_counter()
+            if warm_at is None and now - t_first >= THROUGHPUT_WARMUP_SECS: warm_at, warm_bytes = now, got
+            if got >= max_bytes or now - t_first >= max_secs: break
+        t_end = time.perf_counter()
+        t0, b0 = (warm_at, warm_bytes) if warm_at and t_end - warm_at > 0.1 else (t_first, 0)
+        return {"ttfb_ms": (t_first - t_req) * 1000, "bytes": got, "secs": t_end - t_first,
+                "bytes_per_sec": (got - b0) / (t_end - t0) if t_end > t0 else None, "status": status}
+
+    try:
+        await asyncio.wait_for(_open(), PROBE_CONNECT_TIMEOUT)
+        phase = "ttfb"
+        return await asyncio.wait_for(_download(), PROBE_TOTAL_TIMEOUT + max_secs)
+    except ProbeError: raise
+    except asyncio.TimeoutError: raise ProbeError(phase, "Timeout")
+    except asyncio.IncompleteReadError: raise ProbeError(phase, "Closed")
+    except (OSError, ValueError, asyncio.LimitOverrunError) as e: raise ProbeError(phase, type(e).__name__)
+    finally:
+        if conn:
+            conn[1].close()
+            try: await conn[1].wait_closed()
+            except Exception: pass
+
+# --- Pre-screen (direct TCP/TLS) ---
+class DnsCache:
+    # Async getaddrinfo with TTL'd positive and negative entries. Concurrent lookups of one host share a single
+    # resolver call, so a subscription with hundreds of servers on a few hostnames costs a few lookups.
+    def __init__(self, ttl: float = DNS_CACHE_TTL, negative_ttl: float = DNS_NEGATIVE_TTL) -> None:
+        self.ttl, self.negative_ttl = ttl, negative_ttl
+        self._cache: dict = {} # host -> (expires, [addr, ...] | OSError)
+        self._inflight: dict = {} # host -> Future
+
+    async def resolve(self, host: str) -> list:
+        # Returns the host's addresses (IPv4 first); raises OSError (socket.gaierror) for a failed lookup.
+        try: socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host); return [host] # Literal: nothing to resolve
+        except OSError: pass
+        now = time.monotonic()
+        if (hit := self._cache.get(host)) and hit[0] > now:
+            METRICS.inc("dns_cache_hits")
+            if isinstance(hit[1], OSError): raise type(hit[1])(*hit[1].args)
+            return hit[1]
+        if (fut := self._inflight.get(host)) is None:
+            fut = self._inflight[host] = asyncio.ensure_future(self._lookup(host))
+            fut.add_done_callback(lambda f: (self._inflight.pop(host, None), f.cancelled() or f.exception())) # Retrieved even if every waiter left
+        return await asyncio.shield(fut)
+
+    async def _lookup(self, host: str) -> list:
+        METRICS.inc("dns_lookups")
+        try:
+            with METRICS.timer("dns"): infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except OSError as e: self._cache[host] = (time.monotonic() + self.negative_ttl, e); raise
+        addrs = sorted(dict.fromkeys(i[4][0] for i in infos), key=lambda a: ":" in a)
+        self._cache[host] = (time.monotonic() + self.ttl, addrs)
+        return addrs
+
+_PRESCREEN_SSL: dict = {} # alpn -> SSLContext, built once per distinct ALPN list
+
+def _prescreen_ssl_context(alpn: str) -> ssl.SSLContext:
+    # Handshake-only check: no certificate verification (self-signed and allowInsecure servers are common).
+    if (ctx := _PRESCREEN_SSL.get(alpn)) is None:
+        ctx = _PRESCREEN_SSL[alpn] = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.check_hostname, ctx.verify_mode = False, ssl.CERT_NONE
+        if alpn: ctx.set_alpn_protocols([p for p in alpn.split(",") if p])
+    return ctx
+
+async def prescreen_server(s: ServerRecord, dns: DnsCache) -> str | None:
+    # Cheap reachability check of the server itself, before any Xray spawn: resolve, TCP connect, and for
+    # security "tls" a TLS handshake with the configured SNI. Returns None if it passes, else a failure
+    # message in the probe format ("Fail(Prescreen:tcp:ConnectionRefusedError)").
+    if s.network in PRESCREEN_UDP_NETWORKS: return None
+    phase, writer = "dns", None
+    try:
+        async def _connect() -> asyncio.StreamWriter:
+            nonlocal phase
+            addrs = await dns.resolve(s.address)
+            phase = "tcp"; return (await asyncio.open_connection(addrs[0], s.port))[1]
+        with METRICS.timer("prescreen_tcp"): writer = await asyncio.wait_for(_connect(), PRESCREEN_CONNECT_TIMEOUT)
+        if s.security == "tls":
+            phase = "tls"
+            with METRICS.timer("prescreen_tls"):
+                await asyncio.wait_for(writer.start_tls(_prescreen_ssl_context(s.alpn), server_hostname=s.sni or s.host or s.address), PRESCREEN_TLS_TIMEOUT)
+        return None
+    except asyncio.TimeoutError: return f"Fail(Prescreen:{phase}:Timeout)"
+    except (OSError, ValueError) as e: return f"Fail(Prescreen:{phase}:{type(e).__name__})"
+    finally:
+        if writer is not None: writer.transport.abort() # No graceful (TLS) shutdown: a silent peer would stall it, and a timed-out start_tls leaves close() hanging
+
+# --- HTTP Client ---
+class HttpResponse:
+    __slots__ = ("status", "headers", "body", "url")
+    def __init__(self, status: int, headers: dict, body: bytes, url: str) -> None: self.status, self.headers, self.body, self.url = status, headers, body, url
+
+async def iter_http_body(reader: asyncio.StreamReader, headers: dict, chunk_size: int = 65536):
+    # Yields the response body as it arrives: chunked, Content-Length delimited, or read-until-close.
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                while (await reader.readuntil(b"\r\n")) != b"\r\n": pass # Skip trailers
+                return
+            while size > 0:
+                data = await reader.read(min(chunk_size, size))
+                if not data: raise asyncio.IncompleteReadError(b"", size)
+                size -= len(data); yield data
+            await reader.readexactly(2)
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            data = await reader.read(min(chunk_size, remaining))
+            if not data: raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data); yield data
+    else:
+        while data := await reader.read(chunk_size): yield data
+
+class HttpClient:
+    # Small pooled HTTP/1.1 GET client (keep-alive, chunked, gzip, redirects), replacing per-fetch curl shells.
+    def __init__(self, connect_timeout: float = SUB_FETCH_CONNECT_TIMEOUT, total_timeout: float = SUB_FETCH_TOTAL_TIMEOUT, max_redirects: int = 5) -> None:
+        self.connect_timeout, self.total_timeout, self.max_redirects = connect_timeout, total_timeout, max_redirects
+        self._idle: dict[tuple, list] = {}
+        self._ssl_ctx = ssl.create_default_context()
+
+    async def _connect(self, key: tuple) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof(): return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        tls = {"ssl": self._ssl_ctx, "server_hostname": host} if scheme == "https" else {}
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, **tls), self.connect_timeout)
+        return reader, writer, False
+
+    async def _get_once(self, url: str, headers: dict, on_chunk=None) -> HttpResponse:
+        u = urlsplit(url)
+        if u.scheme not in ("http", "https") or not u.hostname: raise ValueError(f"Unsupported URL: {url[:60]}")
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == "https" else 80))
+        req = f"GET {u.path or '/'}{'?' + u.query if u.query else ''} HTTP/1.1\r\nHost: {u.netloc}\r\nUser-Agent: {APP_TITLE}/{APP_VERSION}\r\nAccept-Encoding: gzip\r\nConnection: keep-alive\r\n"
+        req += "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        for attempt in range(2):
+            reader, writer, reused = await self._connect(key)
+            keep, streamed = False, False
+            try:
+                writer.write(req.encode()); await writer.drain()
+                status, r_headers = await read_http_head(reader)
+                gzipped, no_body = r_headers.get("content-encoding", "").lower() == "gzip", status in (204, 304) or 100 <= status < 200
+                if on_chunk and status == 200: # Streamed: decompress and hand over each piece, keep nothing
+                    unzip = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+                    async for chunk in iter_http_body(reader, r_headers):
+                        streamed = True
+                        if data := unzip.decompress(chunk) if unzip else chunk: on_chunk(data)
+                    if unzip and (data := unzip.flush()): on_chunk(data)
+                    body = b""
+                else:
+                    body = b"" if no_body else b"".join([c async for c in iter_http_body(reader, r_headers)])
+                    if gzipped and body: body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                keep = r_headers.get("connection", "").lower() != "close" and ("content-length" in r_headers or "chunked" in r_headers.get("transfer-encoding", "").lower() or no_body)
+            except (OSError, asyncio.IncompleteReadError):
+                if reused and attempt == 0 and not streamed: continue # Server dropped an idle keep-alive connection; retry on a fresh one
+                raise
+            finally:
+                if keep: self._idle.setdefault(key, []).append((reader, writer))
+                else: writer.close()
+            return HttpResponse(status, r_headers, body, url)
+        raise ConnectionError("unreachable")
+
+    async def get(self, url: str, headers: dict | None = None, on_chunk=None) -> HttpResponse:
+        # With on_chunk, a 200 body is passed to on_chunk(bytes) piece by piece (already un-gzipped) and resp.body is b"".
+        for _ in range(self.max_redirects + 1):
+            resp = await asyncio.wait_for(self._get_once(url, headers or {}, on_chunk), self.total_timeout)
+            if resp.status in (301, 302, 303, 307, 308) and resp.headers.get("location"):
+                url = urljoin(url, resp.headers["location"]); continue
+            return resp
+        raise ConnectionError(f"Too many redirects ({self.max_redirects})")
+
+    def close(self) -> None:
+        for conns in self._idle.values():
+            for _, writer in conns: writer.close()
+        self._idle.clear()
+
+async def _probe_test_inbound(s_name: str, test_port: int) -> dict:
+    try:
+        timings = await socks5_http_probe(test_port, samples=PROBE_SAMPLES)
+    except ProbeError as e:
+        return {"alive": False, "latency_ms": None, "message": f"Fail(Probe:{e})", "timings": None}
+    except Exception as e:
+        return {"alive": False, "latency_ms": None, "message": f"ExTest:{s_name}:{str(e)[:30]}", "timings": None}
+    for phase in ("handshake", "connect", "ttfb"): METRICS.observe(f"probe_{phase}", timings[f"{phase}_ms"])
+    METRICS.observe("probe", timings["total_ms"])
+    samples, lost = timings.get("samples", []), timings.get("lost", 0) # Absent with PROBE_SAMPLES = 0
+    for ms in samples: METRICS.observe("probe_sample", ms)
+    if samples or lost: stats = latency_stats(samples, lost)
+    else: stats = latency_stats([timings["total_ms"]]) # No keep-alive: rank on the cold request
+    if stats["median_ms"] is None: stats.update(median_ms=timings["total_ms"], p90_ms=timings["total_ms"], jitter_ms=0.0) # All samples lost
+    score = composite_score(stats)
+    return {"alive": True, "latency_ms": stats["median_ms"], "score": score, "stats": stats, "timings": timings,
+            "message": f"{int(stats['median_ms'])}ms p90 {int(stats['p90_ms'])} jit {int(stats['jitter_ms'])} loss {stats['loss']:.0%} (score {int(score)})"}
+
+async def wait_for_xray_ready(proc: asyncio.subprocess.Process, ports: list, timeout: float | None = None) -> bool:
+    # Polls the inbound ports until all accept connections. Returns False as soon as Xray exits, or at the deadline.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (XRAY_READY_TIMEOUT if timeout is None else timeout)
+    pending = list(ports)
+    while pending:
+        if proc.returncode is not None: return False
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", pending[-1]); w.close(); pending.pop(); continue
+        except OSError: pass
+        if loop.time() >= deadline: return False
+        await asyncio.sleep(XRAY_READY_POLL_INTERVAL)
+    return proc.returncode is None
+
+def wait_for_xray_ready_blocking(proc: subprocess.Popen, ports: list, timeout: float | None = None) -> bool:
+    # Synchronous twin of wait_for_xray_ready for the Popen-based main connection.
+    deadline = time.monotonic() + (XRAY_READY_TIMEOUT if timeout is None else timeout)
+    pending = list(ports)
+    while pending:
+        if proc.poll() is not None: return False
+        try:
+            with socket.create_connection(("127.0.0.1", pending[-1]), timeout=XRAY_READY_POLL_INTERVAL): pending.pop(); continue
+        except OSError: pass
+        if time.monotonic() >= deadline: return False
+        time.sleep(XRAY_READY_POLL_INTERVAL)
+    return proc.poll() is None
+
+async def xray_reads_stdin_config() -> bool:
+    # Whether this Xray accepts `run -c stdin:` (checked once per process with `run -test`, no inbounds opened).
+    global XRAY_CONFIG_STDIN
+    if XRAY_CONFIG_STDIN is None:
+        try: proc = await asyncio.create_subprocess_exec(str(XRAY_PATH), "run", "-test", "-c", "stdin:", stdin=asyncio.subprocess.PIPE,
+                                                         stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        except OSError: return False # No usable Xray yet: decide once it exists
+        try:
+            await asyncio.wait_for(proc.communicate(b'{"log":{"loglevel":"none"},"outbounds":[{"protocol":"freedom"}]}'), XRAY_READY_TIMEOUT)
+            XRAY_CONFIG_STDIN = proc.returncode == 0
+        except (OSError, asyncio.TimeoutError):
+            if proc.returncode is None: proc.kill(); await proc.wait()
+            XRAY_CONFIG_STDIN = False
+    return XRAY_CONFIG_STDIN
+
+async def spawn_test_xray(config: bytes, name: str) -> tuple[asyncio.subprocess.Process, Path | None]:
+    # Starts a test Xray on config bytes: through stdin when supported (no file at all), else a private (0600,
+    # exclusively created) scratch file that the caller unlinks. Returns (proc, scratch_path or None).
+    if await xray_reads_stdin_config():
+        proc = await asyncio.create_subprocess_exec(str(XRAY_PATH), "run", "-c", "stdin:", stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        try: proc.stdin.write(config); await proc.stdin.drain(); proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError): pass # Exited early; wait_for_xray_ready reports it
+        return proc, None
+    fd, path = tempfile.mkstemp(prefix=f"v2rtc_test_{name}_", suffix=".json", dir=TEST_SCRATCH_DIR); path = Path(path) # Holds UUIDs/passwords
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(config)
+        return await asyncio.create_subprocess_exec(str(XRAY_PATH), "run", "-c", str(path), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL), path
+    except BaseException: path.unlink(missing_ok=True); raise # Incl. cancellation: the caller never sees the path
+
+async def test_server_batch(server_configs: list, socks_ports: list) -> list[dict]:
+    # Tests a batch of servers through one shared Xray process. Returns {alive, latency_ms, message, timings} per server.
+    names = [s.name for s in server_configs]
+    with METRICS.timer("xray_config"):
+        x_json = generate_batch_xray_config(server_configs, socks_ports)
+    if not x_json:
+        return [{"alive": False, "latency_ms": None, "message": f"GenTestCfgFail:{n}", "timings": None} for n in names]
+
+    p_xray_test = tmp_cfg_file = None
+    try:
+        with METRICS.timer("xray_spawn"):
+            p_xray_test, tmp_cfg_file = await spawn_test_xray(x_json, str(socks_ports[0]))
+        METRICS.inc("xray_spawns")
+        with METRICS.timer("xray_ready"):
+            ready = await wait_for_xray_ready(p_xray_test, socks_ports)
+        if ready:
+            return list(await asyncio.gather(*(_probe_test_inbound(n, port) for n, port in zip(names, socks_ports))))
+        start_rc = p_xray_test.returncode
+        if start_rc is None:
+            METRICS.inc("xray_not_ready")
+            return [{"alive": False, "latency_ms": None, "message": f"XrayTestNotReady:{n}({XRAY_READY_TIMEOUT}s)", "timings": None} for n in names]
+        METRICS.inc("xray_start_failures")
+    except Exception as e:
+        return [{"alive": False, "latency_ms": None, "message": f"ExTest:{n}:{str(e)[:30]}", "timings": None} for n in names]
+    finally:
+        t_cleanup = time.perf_counter()
+        if p_xray_test and p_xray_test.returncode is None:
+            try:
+                p_xray_test.terminate()
+                await asyncio.wait_for(p_xray_test.wait(), timeout=1.0)
+            except (ProcessLookupError, asyncio.TimeoutError, Exception):
+                try:
+                    if p_xray_test.returncode is None: p_xray_test.kill(); await p_xray_test.wait()
+                except (ProcessLookupError, Exception): pass # Already gone or other issue
+        if tmp_cfg_file:
+            try: tmp_cfg_file.unlink(missing_ok=True)
+            except Exception: pass
+        METRICS.observe("xray_cleanup", (time.perf_counter() - t_cleanup) * 1000)
+
+    # Xray exited early. One bad outbound rejects the whole config, so bisect the batch to isolate it.
+    if len(server_configs) == 1:
+        return [{"alive": False, "latency_ms": None, "message": f"XrayTestStartFail:{names[0]}(RC:{start_rc})", "timings": None}]
+    mid = len(server_configs) // 2
+    return (await test_server_batch(server_configs[:mid], socks_ports[:mid])) + (await test_server_batch(server_configs[mid:], socks_ports[mid:]))
+
+async def throughput_test_batch(server_configs: list, socks_ports: list, url: str | None = None) -> list[dict]:
+    # Bandwidth stage: one Xray for the batch, downloads run one after another so servers do not compete for the
+    # local link. Returns {"bytes_per_sec", "ttfb_ms", "bytes", "secs", "message"} per server (bytes_per_sec None on failure).
+    fail = lambda msg: {"bytes_per_sec": None, "ttfb_ms": None, "bytes": 0, "secs": 0.0, "message": msg}
+    x_json = generate_batch_xray_config(server_configs, socks_ports)
+    if not x_json: return [fail("GenTestCfgFail") for _ in server_configs]
+    proc = tmp_cfg_file = None
+    try:
+        proc, tmp_cfg_file = await spawn_test_xray(x_json, f"tp_{socks_ports[0]}")
+        METRICS.inc("xray_spawns")
+        if not await wait_for_xray_ready(proc, socks_ports): return [fail(f"XrayTestStartFail(RC:{proc.returncode})") for _ in server_configs]
+        results = []
+        for port in socks_ports:
+            try:
+                with METRICS.timer("throughput"): tp = await socks5_http_download(port, url)
+                tp["message"] = f"{fmt_rate(tp['bytes_per_sec'])} (ttfb {int(tp['ttfb_ms'])}ms, {tp['bytes'] // 1000} kB)"
+            except ProbeError as e: tp = fail(f"Fail(Throughput:{e})"); METRICS.record_failure(tp["message"])
+            results.append(tp)
+        return results
+    except Exception as e: return [fail(f"ExTest:{str(e)[:30]}") for _ in server_configs]
+    finally:
+        if proc and proc.returncode is None:
+            proc.terminate()
+            try: await asyncio.wait_for(proc.wait(), XRAY_STOP_TIMEOUT)
+            except asyncio.TimeoutError: proc.kill(); await proc.wait()
+        if tmp_cfg_file: tmp_cfg_file.unlink(missing_ok=True)
+
+# --- Server Health Store ---
+class HealthStore:
+    # SQLite-backed per-server history: latency samples, EWMA, last success and failure streak.
+    ADDED_COLUMNS = ("last_score REAL", "last_p90_ms REAL", "last_jitter_ms REAL", "last_loss REAL") # Appended to older DBs on open
+
+    def __init__(self, db_path: Path) -> None:
+        self.db = sqlite3.connect(str(db_path))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS servers (
+                key TEXT PRIMARY KEY, name TEXT, last_tested REAL, last_success REAL, last_latency_ms REAL,
+                ewma_ms REAL, fail_streak INTEGER NOT NULL DEFAULT 0, tests INTEGER NOT NULL DEFAULT 0, successes INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS latency_history (key TEXT NOT NULL, ts REAL NOT NULL, latency_ms REAL);
+            CREATE INDEX IF NOT EXISTS latency_history_key_ts ON latency_history (key, ts);
+        """)
+        have = {r["name"] for r in self.db.execute("PRAGMA table_info(servers)")}
+        with self.db:
+            for col in self.ADDED_COLUMNS:
+                if col.split()[0] not in have: self.db.execute(f"ALTER TABLE servers ADD COLUMN {col}")
+
+    def get_many(self, keys: list) -> dict:
+        rows = {}
+        for i in range(0, len(keys), 500): # Stay under SQLite's bound-parameter limit
+            chunk = keys[i:i + 500]
+            for r in self.db.execute(f"SELECT * FROM servers WHERE key IN ({','.join('?' * len(chunk))})", chunk): rows[r["key"]] = dict(r)
+        return rows
+
+    @staticmethod
+    def backoff_secs(fail_streak: int) -> float:
+        if fail_streak < HEALTH_BACKOFF_AFTER_FAILS: return 0.0
+        return min(HEALTH_BACKOFF_BASE_SECS * 2 ** (fail_streak - HEALTH_BACKOFF_AFTER_FAILS), HEALTH_BACKOFF_MAX_SECS)
+
+    def plan(self, configs: list, now: float | None = None, force: bool = False) -> tuple[list, list, int]:
+        # Splits configs into (to_test, fresh, backed_off). to_test is ordered recent-good first (by EWMA),
+        # then never-seen, then dead servers whose backoff expired. fresh holds (conf, row) pairs whose last
+        # success is recent enough to reuse without a retest. force=True retests everything.
+        if force: return list(configs), [], 0
+        now = now or time.time()
+        rows = self.get_many([c.key for c in configs])
+        good, unknown, dead, fresh, backed_off = [], [], [], [], 0
+        for conf in configs:
+            row = rows.get(conf.key)
+            if row is None: unknown.append(conf)
+            elif row["fail_streak"] == 0 and row["last_success"] and now - row["last_success"] < HEALTH_FRESH_SECS: fresh.append((conf, row))
+            elif row["fail_streak"] == 0: good.append((row["ewma_ms"] or float("inf"), conf))
+            elif now - (row["last_tested"] or 0) < self.backoff_secs(row["fail_streak"]): backed_off += 1
+            else: dead.append((row["fail_streak"], conf))
+        good.sort(key=lambda x: x[0]); dead.sort(key=lambda x: x[0])
+        return [c for _, c in good] + unknown + [c for _, c in dead], fresh, backed_off
+
+    def record_results(self, results: list, now: float | None = None) -> None:
+        # results: [{"config": conf, "alive": bool, "latency_ms": float | None, "score"?, "stats"?}, ...], one transaction.
+        # Local failures (missing/overloaded Xray, see TEST_CONGESTION_MARKERS) say nothing about the server: not recorded.
+        now, results = now or time.time(), [r for r in results if not is_local_failure(r)]
+        rows = self.get_many([r["config"].key for r in results])
+        with self.db:
+            for res in results:
+                key, lat = res["config"].key, res.get("latency_ms") if res.get("alive") else None
+                row = rows.get(key) or {"ewma_ms": None, "fail_streak": 0, "last_success": None, "tests": 0, "successes": 0}
+                if lat is not None:
+                    ewma = lat if row["ewma_ms"] is None else HEALTH_EWMA_ALPHA * lat + (1 - HEALTH_EWMA_ALPHA) * row["ewma_ms"]
+                    streak, last_success, successes = 0, now, row["successes"] + 1
+                else:
+                    ewma, streak, last_success, successes = row["ewma_ms"], row["fail_streak"] + 1, row["last_success"], row["successes"]
+                st = (res.get("stats") or {}) if lat is not None else {}
+                self.db.execute("INSERT OR REPLACE INTO servers (key, name, last_tested, last_success, last_latency_ms, ewma_ms, fail_streak, tests, successes, "
+                                "last_score, last_p90_ms, last_jitter_ms, last_loss) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                                (key, res["config"].name, now, last_success, lat, ewma, streak, row["tests"] + 1, successes,
+                                 res.get("score") if lat is not None else None, st.get("p90_ms"), st.get("jitter_ms"), st.get("loss")))
+                self.db.execute("INSERT INTO latency_history VALUES (?,?,?)", (key, now, lat))
+                self.db.execute("DELETE FROM latency_history WHERE key = ? AND ts < (SELECT ts FROM latency_history WHERE key = ? ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                                (key, key, HEALTH_HISTORY_LEN - 1))
+
+    def close(self) -> None: self.db.close()
+
+# --- Test Scheduling ---
+class AdaptiveLimiter:
+    # AIMD limit on concurrent Xray test processes: +1 per window of clean batches, halved on congestion (spawn
+    # errors, Xray not ready in time, local SOCKS handshake failures). Growth pauses while the 1-min load average
+    # exceeds TEST_LOAD_PER_CPU per core.
+    def __init__(self, initial: int, minimum: int, maximum: int) -> None:
+        self.minimum, self.maximum = minimum, max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.in_flight, self._last_decrease = 0, 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, congested: bool | None = False) -> None:
+        # congested=None frees the slot without counting it as a sample.
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease > TEST_AIMD_COOLDOWN: # One decrease per congestion event, not per batch in it
+                    self.limit = max(self.minimum, self.limit / 2); self._last_decrease = now
+            elif congested is not None and not self._overloaded():
+                self.limit = min(self.maximum, self.limit + 1 / int(self.limit))
+            self._cond.notify_all()
+
+    @staticmethod
+    def _overloaded() -> bool:
+        try: return os.getloadavg()[0] > (os.cpu_count() or 1) * TEST_LOAD_PER_CPU
+        except (OSError, AttributeError): return False # /proc/loadavg is unreadable on newer Android
+
+class PortPool:
+    # Leases local ports for test inbounds. A port is handed out only after a successful bind check and stays
+    # leased until released, so in-flight batches never share a port (or the temp config named after it).
+    def __init__(self, base: int, size: int) -> None:
+        self._free = collections.deque(range(base, base + size))
+        self._leased = 0
+        self._cond = asyncio.Condition()
+
+    @staticmethod
+    def _is_free(port: int) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Same as Xray's listener, so TIME_WAIT doesn't count as busy
+            try: s.bind(("127.0.0.1", port)); return True
+            except OSError: return False
+
+    async def lease(self, n: int) -> list:
+        async with self._cond:
+            while True:
+                ports, busy = [], []
+                while len(ports) < n and self._free:
+                    p = self._free.popleft()
+                    (ports if self._is_free(p) else busy).append(p)
+                self._free.extend(busy) # Held by another program; retry them last
+                if len(ports) == n: self._leased += n; return ports
+                self._free.extendleft(reversed(ports))
+                if not self._leased: raise RuntimeError(f"No {n} free test ports in pool")
+                await self._cond.wait()
+
+    async def release(self, ports: list) -> None:
+        async with self._cond:
+            self._free.extend(ports); self._leased -= len(ports) # Back of the queue: give sockets time to close
+            self._cond.notify_all()
+
+def is_local_failure(res: dict) -> bool: return str(res.get("message", "")).startswith(TEST_CONGESTION_MARKERS)
+
+def batch_congested(results: list) -> bool: return any(is_local_failure(r) for r in results)
+
+# --- Sharded Tester Workers ---
+# Only multiprocessing Pipes (no Queue/Lock): those need sem_open, which Android lacks. Protocol, worker -> parent:
+# ("want",) per free concurrency slot, ("results", batch_id, results, limit, metrics_state), ("done",);
+# parent -> worker: (batch_id, [ServerRecord, ...]) or None once the test queue is drained.
+async def conn_recv(conn):
+    # Awaits a message on a multiprocessing Connection without blocking the loop (or parking a thread in recv).
+    loop, ready = asyncio.get_running_loop(), asyncio.Event()
+    loop.add_reader(conn.fileno(), ready.set)
+    try: await ready.wait()
+    finally: loop.remove_reader(conn.fileno())
+    return conn.recv()
+
+def run_test_worker(conn, port_base: int, port_size: int, max_concurrent: int, settings: dict) -> None:
+    # Process entry point: its own asyncio loop, AIMD limiter and port range. SIGTERM cancels it so the
+    # finally blocks in test_server_batch still stop its Xray processes.
+    globals().update(settings)
+    async def _main() -> None:
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        await _test_worker(conn, port_base, port_size, max_concurrent)
+    try: asyncio.run(_main())
+    except (asyncio.CancelledError, KeyboardInterrupt, EOFError, OSError): pass
+    finally: conn.close()
+
+async def _test_worker(conn, port_base: int, port_size: int, max_concurrent: int) -> None:
+    limiter = AdaptiveLimiter(min(INITIAL_CONCURRENT_TESTS, max_concurrent), MIN_CONCURRENT_TESTS, max_concurrent)
+    ports, running = PortPool(port_base, port_size), set()
+
+    async def _run(batch_id: int, batch: list, leased: list) -> None:
+        congested, t0, results = True, time.perf_counter(), None
+        try:
+            results = await test_server_batch(batch, leased); congested = batch_congested(results)
+        except Exception as e:
+            results = [{"alive": False, "latency_ms": None, "message": f"ExTest:{s.name}:{str(e)[:30]}", "timings": None} for s in batch]
+        finally:
+            await ports.release(leased); await limiter.release(congested)
+            METRICS.observe("batch", (time.perf_counter() - t0) * 1000)
+        conn.send(("results", batch_id, results, int(limiter.limit), METRICS.state())); METRICS.reset()
+
+    try:
+        while True:
+            await limiter.acquire()
+            conn.send(("want",))
+            if (msg := await conn_recv(conn)) is None: await limiter.release(None); break
+            batch_id, batch = msg
+            leased = await ports.lease(len(batch))
+            task = asyncio.create_task(_run(batch_id, batch, leased)); running.add(task); task.add_done_callback(running.discard)
+        await asyncio.gather(*running)
+        conn.send(("done",))
+    finally:
+        for t in running: t.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+# --- Update Pipeline ---
+class UpdatePipeline:
+    # Streaming fetch -> decode/parse -> pre-screen -> test pipeline on asyncio queues. Links from a subscription are
+    # parsed as soon as it arrives, servers that refuse a direct TCP/TLS connect are dropped without an Xray spawn,
+    # and test batches start once TEST_BATCH_SIZE servers queue up (or TEST_BATCH_LINGER passes), so results reach
+    # on_result while other subscriptions are still downloading.
+    def __init__(self, http: HttpClient, health: HealthStore | None, subs_cache: dict, log_fn, on_result, force_full: bool = False,
+                 prescreen: bool = True, workers: int = TEST_WORKERS) -> None:
+        # health may be None when only fetch_sub is used (headless `update`). workers > 1 runs the Xray stage in
+        # that many processes (see run_test_worker); everything else stays on this loop. log_fn(message, is_error=False,
+        # fold=None): per-server failures carry a fold key so a LogBuffer can count them instead of listing each.
+        self.http, self.health, self.subs_cache = http, health, subs_cache
+        self.log_fn, self.on_result, self.force_full, self.prescreen, self.workers = log_fn, on_result, force_full, prescreen, workers
+        self.dns = DnsCache()
+        self.record_q: asyncio.Queue = asyncio.Queue()
+        self.screen_q: asyncio.Queue = asyncio.Queue()
+        self.test_q: asyncio.Queue = asyncio.Queue()
+        self.limiter = AdaptiveLimiter(INITIAL_CONCURRENT_TESTS, MIN_CONCURRENT_TESTS, MAX_CONCURRENT_TESTS)
+        self.ports = PortPool(TEST_SOCKS_PORT_BASE, TEST_PORT_POOL_SIZE)
+        self.stats = {"subs_fetched": 0, "links": 0, "parsed": 0, "fresh": 0, "backed_off": 0, "screened_out": 0, "tested": 0, "alive": 0, "concurrency": INITIAL_CONCURRENT_TESTS}
+
+    async def run(self, subscriptions: list, test: bool = True) -> list:
+        # Returns the subscription list with refreshed last_update stamps. test=False only refreshes the subscriptions.
+        subs, t0 = [dict(s) for s in subscriptions], time.perf_counter()
+        stages = [asyncio.create_task(self._fetch_all(subs, feed=test))]
+        if test:
+            stages += [asyncio.create_task(self._plan_servers()), asyncio.create_task(self._prescreen()),
+                       asyncio.create_task(self._dispatch_sharded() if self.workers > 1 else self._dispatch_tests())]
+        try: await asyncio.gather(*stages)
+        finally:
+            for t in stages: t.cancel()
+            METRICS.observe("update_run", (time.perf_counter() - t0) * 1000)
+        return subs
+
+    async def _fetch_all(self, subs: list, feed: bool = True) -> None:
+        async def _one(i: int, sub_entry: dict) -> None:
+            def on_records(records: list) -> None: # Planning starts while the body is still downloading
+                if feed: self.record_q.put_nowait(records)
+            res = await self.fetch_sub(sub_entry, i, on_records)
+            if isinstance(res, Exception):
+                self.log_fn(f"Err fetch sub {sub_entry.get('name')}: {res}", True)
+                if cached := self.cached_records(sub_entry.get("url")): # Retest what we had instead of losing it (dups are skipped)
+                    self.stats["links"] += len(cached); self.log_fn(f"Using {len(cached)} cached servers for {sub_entry.get('name')}."); on_records(cached)
+                return
+            self.stats["subs_fetched"] += 1; sub_entry["last_update"] = time.strftime('%y-%m-%d %H:%M', time.localtime())
+        try: await asyncio.gather(*(_one(i, s) for i, s in enumerate(subs)))
+        finally: await self.record_q.put(None)
+
+    async def fetch_sub(self, sub_entry: dict, index: int, on_records=None) -> list | Exception:
+        # The body is hashed, decoded (see SubscriptionDecoder) and parsed as it streams in; on_records(list) receives each
+        # run of ServerRecords straight away. The cache keeps the parsed records, so a 304 costs no decode or parse work.
+        # Returns every record, or the exception.
+        url, name = sub_entry.get("url"), sub_entry.get("name", f"S_{index+1}")
+        self.log_fn(f"Fetching: {name}...")
+        cached = self.subs_cache.get(url) or {}
+        cond_headers = {h: cached[k] for h, k in (("If-None-Match", "etag"), ("If-Modified-Since", "last_modified")) if cached.get(k)}
+        decoder, digest, records, size, t_decode = SubscriptionDecoder(), hashlib.sha256(), [], 0, 0.0
+        def emit(new: list) -> None:
+            if new: records.extend(new); on_records and on_records(new)
+        def decoded(links: list) -> None:
+            if not links: return
+            self.stats["links"] += len(links)
+            with METRICS.timer("parse"): emit([conf for link in links if (conf := parse_link(link))])
+        def on_chunk(data: bytes) -> None:
+            nonlocal size, t_decode
+            t0 = time.perf_counter(); size += len(data); digest.update(data)
+            new = list(decoder.feed(data)); t_decode += time.perf_counter() - t0; decoded(new)
+        try:
+            with METRICS.timer("sub_fetch"): resp = await self.http.get(url, cond_headers, on_chunk)
+            t0 = time.perf_counter(); new = list(decoder.close()); t_decode += time.perf_counter() - t0; decoded(new)
+        except Exception as e:
+            METRICS.inc("sub_fetch_errors"); return ConnectionError(f"Fetch {name}: {type(e).__name__}:{str(e)[:80] or 'N/A'}")
+        METRICS.inc("subs_fetched")
+        if resp.status == 304 and (cached_records := self.cached_records(url)) is not None:
+            METRICS.inc("subs_not_modified"); self.stats["links"] += len(cached_records)
+            self.log_fn(f"{name} unchanged (304), {len(cached_records)} cached servers."); emit(cached_records); return records
+        if resp.status != 200 or not size: METRICS.inc("sub_fetch_errors"); return ConnectionError(f"Fetch {name}(HTTP {resp.status})")
+        METRICS.observe("sub_decode", t_decode * 1000)
+        body_hash = digest.hexdigest() # Only known once the body is in, so an unchanged body has been decoded and parsed by now
+        same = " (body unchanged)" if body_hash == cached.get("sha256") else ""
+        self.log_fn(f"Decoded {len(records)} servers ({decoder.format}) from {name}{same}.")
+        self.subs_cache[url] = {"etag": resp.headers.get("etag"), "last_modified": resp.headers.get("last-modified"), "sha256": body_hash,
+                                "records": [{k: v for k, v in r.to_dict().items() if v} for r in records]} # Falsy fields fall back to the defaults
+        return records
+
+    def cached_records(self, url: str) -> list | None:
+        # ServerRecords from the subscription cache (None when there is no entry); pre-"records" entries hold raw links.
+        cached = self.subs_cache.get(url) or {}
+        if "records" in cached:
+            with METRICS.timer("cache_load"): return [ServerRecord.from_dict(d) for d in cached["records"]]
+        if "links" in cached:
+            with METRICS.timer("parse"): return [conf for link in cached["links"] if (conf := parse_link(link))]
+        return None
+
+    async def _plan_servers(self) -> None:
+        seen = set() # Canonical server keys, so relabelled duplicates are tested once
+        try:
+            while (records := await self.record_q.get()) is not None:
+                configs = []
+                for conf in records:
+                    if conf.key not in seen: seen.add(conf.key); configs.append(conf)
+                with METRICS.timer("health_plan"): to_test, fresh, backed_off = self.health.plan(configs, force=self.force_full)
+                self.stats["parsed"] += len(configs); self.stats["fresh"] += len(fresh); self.stats["backed_off"] += backed_off
+                for conf, row in fresh:
+                    self.stats["alive"] += 1
+                    stats = {"median_ms": row["last_latency_ms"], "p90_ms": row["last_p90_ms"], "jitter_ms": row["last_jitter_ms"], "loss": row["last_loss"]}
+                    self.on_result({"config":conf, "ps":conf.name, "alive":True, "latency_ms":row["last_latency_ms"], "score":row["last_score"],
+                                    "stats":stats if row["last_score"] is not None else None, "message":"cached", "timings":None, "cached":True})
+                for conf in to_test: self.screen_q.put_nowait(conf)
+        finally: self.screen_q.put_nowait(None)
+
+    async def _prescreen(self) -> None:
+        # Up to PRESCREEN_CONCURRENCY direct checks in flight; passing servers go on to the Xray stage in the order they
+        # pass, the rest are recorded as failures (so health backoff applies) in PRESCREEN_RECORD_CHUNK transactions.
+        sem, running, failed = asyncio.Semaphore(PRESCREEN_CONCURRENCY), set(), []
+
+        def _flush() -> None:
+            with METRICS.timer("health_record"): self.health.record_results(failed)
+            for res in failed:
+                reason = METRICS.record_failure(res["message"]); self.log_fn(f"Test fail: {res['ps']} - {res['message']}", fold=f"Test fail: {reason}")
+            failed.clear()
+
+        async def _one(conf: ServerRecord) -> None:
+            try:
+                with METRICS.timer("prescreen"): msg = await prescreen_server(conf, self.dns)
+            finally: sem.release()
+            if msg is None: self.test_q.put_nowait(conf); return
+            self.stats["screened_out"] += 1; METRICS.inc("screened_out")
+            failed.append({"config": conf, "ps": conf.name, "alive": False, "latency_ms": None, "message": msg, "timings": None})
+            if len(failed) >= PRESCREEN_RECORD_CHUNK: _flush()
+
+        try:
+            while (conf := await self.screen_q.get()) is not None:
+                if not self.prescreen: self.test_q.put_nowait(conf); continue
+                await sem.acquire()
+                task = asyncio.create_task(_one(conf)); running.add(task); task.add_done_callback(running.discard)
+            await asyncio.gather(*running)
+            if failed: _flush()
+        finally:
+            for t in running: t.cancel()
+            self.test_q.put_nowait(None)
+
+    async def run_throughput(self, results: list, top_n: int = THROUGHPUT_TOP_N, url: str | None = None) -> list:
+        # Optional second stage: bandwidth test for the top_n live results by rank_key. Sets res["throughput"] in
+        # place and returns the tested results; sort with throughput_rank_key to rank by it.
+        top = sorted((r for r in results if r.get("alive")), key=rank_key)[:top_n]
+        if not top: return []
+        self.log_fn(f"Throughput test: top {len(top)} via {url or THROUGHPUT_URL}...")
+        ports = await self.ports.lease(len(top))
+        try: measured = await throughput_test_batch([r["config"] for r in top], ports, url)
+        finally: await self.ports.release(ports)
+        for res, tp in zip(top, measured):
+            res["throughput"] = tp; self.log_fn(f"Throughput {res['config'].name}: {tp['message']}", tp["bytes_per_sec"] is None)
+        return top
+
+    async def _next_batch(self) -> list | None:
+        # Blocks for one queued server, then fills up to TEST_BATCH_SIZE within TEST_BATCH_LINGER seconds.
+        if (first := await self.test_q.get()) is None: self.test_q.put_nowait(None); return None
+        batch, loop = [first], asyncio.get_running_loop()
+        deadline = loop.time() + TEST_BATCH_LINGER
+        while len(batch) < TEST_BATCH_SIZE:
+            if self.test_q.empty():
+                if (remaining := deadline - loop.time()) <= 0: break
+                await asyncio.sleep(min(remaining, 0.02)); continue
+            if (item := self.test_q.get_nowait()) is None: self.test_q.put_nowait(None); break # Keep the sentinel for the next call
+            batch.append(item)
+        return batch
+
+    async def _dispatch_tests(self) -> None:
+        # Takes a concurrency slot, then the next batch (which fills while waiting), then a port lease.
+        running = set()
+        try:
+            while True:
+                await self.limiter.acquire()
+                if (batch := await self._next_batch()) is None: await self.limiter.release(None); break
+                try: ports = await self.ports.lease(len(batch))
+                except Exception: await self.limiter.release(None); raise
+                task = asyncio.create_task(self._run_batch(batch, ports)); running.add(task); task.add_done_callback(running.discard)
+            await asyncio.gather(*running)
+        finally:
+            for t in running: t.cancel()
+
+    async def _dispatch_sharded(self) -> None:
+        # Multi-core mode: worker processes pull batches ("want") as their own limiters allow and stream results back.
+        ctx = multiprocessing.get_context("spawn") # No fork: the TUI parent has threads
+        size, per_worker = TEST_PORT_POOL_SIZE // self.workers, max(MIN_CONCURRENT_TESTS, MAX_CONCURRENT_TESTS // self.workers)
+        await xray_reads_stdin_config() # Probed once here rather than once per worker
+        settings = {k: globals()[k] for k in TEST_WORKER_SETTINGS}
+        procs, conns, limits, batch_lock, pending, batch_ids = [], [], {}, asyncio.Lock(), {}, itertools.count()
+        for i in range(self.workers):
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=run_test_worker, args=(child_conn, TEST_SOCKS_PORT_BASE + i * size, size, per_worker, settings), daemon=True)
+            p.start(); child_conn.close(); procs.append(p); conns.append(parent_conn)
+        self.log_fn(f"Testing in {self.workers} worker processes (up to {per_worker} Xray each).")
+
+        async def _feed(i: int, conn) -> None:
+            async with batch_lock: batch = await self._next_batch() # One filler at a time keeps batches full
+            if batch is None: conn.send(None); return
+            batch_id = next(batch_ids); pending[batch_id] = (i, batch); conn.send((batch_id, batch))
+
+        async def _serve(i: int, conn) -> None:
+            feeders = set()
+            try:
+                while True:
+                    try: msg = await conn_recv(conn)
+                    except (EOFError, OSError):
+                        lost = sum(len(b) for w, b in pending.values() if w == i)
+                        self.log_fn(f"Test worker {i} exited ({procs[i].exitcode}); {lost} servers untested.", True); return
+                    if msg[0] == "want":
+                        task = asyncio.create_task(_feed(i, conn)); feeders.add(task); task.add_done_callback(feeders.discard)
+                    elif msg[0] == "results":
+                        _, batch_id, results, limits[i], m_state = msg
+                        METRICS.merge(*m_state); self.stats["concurrency"] = sum(limits.values())
+                        self._handle_results(pending.pop(batch_id)[1], results)
+                    else: return
+            finally:
+                for t in feeders: t.cancel()
+
+        try: await asyncio.gather(*(_serve(i, c) for i, c in enumerate(conns)))
+        finally:
+            for c in conns: c.close() # A worker still waiting for work sees EOF
+            for p in procs:
+                if p.is_alive(): p.terminate()
+            await asyncio.gather(*(asyncio.to_thread(p.join, XRAY_STOP_TIMEOUT + 1) for p in procs))
+            for p in procs:
+                if p.is_alive(): p.kill()
+
+    async def _run_batch(self, batch: list, ports: list) -> None:
+        congested, t0 = True, time.perf_counter()
+        try:
+            results = await test_server_batch(batch, ports)
+            congested = batch_congested(results)
+        except Exception as e:
+            self.log_fn(f"Ex during test batch ({len(batch)} servers): {e}", True); return
+        finally:
+            await self.ports.release(ports); await self.limiter.release(congested)
+            METRICS.observe("batch", (time.perf_counter() - t0) * 1000)
+        self.stats["concurrency"] = int(self.limiter.limit)
+        self._handle_results(batch, results)
+
+    def _handle_results(self, batch: list, results: list) -> None:
+        results = [{"config":conf, "ps":conf.name, **res} for conf, res in zip(batch, results)]
+        with METRICS.timer("health_record"): self.health.record_results(results)
+        self.stats["tested"] += len(results)
+        METRICS.inc("tests", len(results))
+        for res in results:
+            if res.get("alive"): self.stats["alive"] += 1; METRICS.inc("alive"); self.on_result(res)
+            else:
+                reason = METRICS.record_failure(res.get("message")); self.log_fn(f"Test fail: {res.get('ps')} - {res.get('message')}", fold=f"Test fail: {reason}")
+
+async def setup_xray_core(log_fn, show_modal_fn) -> bool:
+    log_fn("Xray core not found. Attempting download setup...")
+    arch_map = {"aarch64": "linux-arm64-v8a", "armv7l": "linux-arm32-v7a", "armv8l": "linux-arm64-v8a", "x86_64": "linux-64", "i686": "linux-32"}
+    current_arch = platform.machine().lower()
+    xray_arch_name = arch_map.get(current_arch)
+    if not xray_arch_name:
+        msg = f"Unsupported arch: {current_arch}. Install Xray manually."; log_fn(msg, True); await show_modal_fn(msg); return False
+    # --- Corrected Indentation Starts Here ---
+    latest_release_url = "https://api.github.com/repos/XTLS/Xray-core/releases/latest"
+    download_url_template = "https://github.com/XTLS/Xray-core/releases/download/{tag}/Xray-{arch}.zip"
+    try:
+        log_fn("Fetching latest Xray release version..."); curl_cmd_tag = f"curl -sL {latest_release_url}"
+        p_tag = await asyncio.create_subprocess_shell(curl_cmd_tag, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        s_tag, e_tag = await p_tag.communicate()
+        if p_tag.returncode != 0:
+            msg = f"Failed to fetch release info: {e_tag.decode(errors='ignore')[:100]}"; log_fn(msg, True); await show_modal_fn(msg + "\nInstall manually."); return False
+        latest_tag = json.loads(s_tag.decode(errors='ignore')).get("tag_name")
+        if not latest_tag:
+            msg = "Could not get latest Xray tag."; log_fn(msg, True); await show_modal_fn(msg + "\nInstall manually."); return False
+        log_fn(f"Latest Xray: {latest_tag}"); xray_zip_url = download_url_template.format(tag=latest_tag, arch=xray_arch_name)
+        xray_zip_path = SCRIPT_DIR / f"Xray-{xray_arch_name}.zip"
+        log_fn(f"Downloading: {xray_zip_url}"); curl_cmd_dl = f"curl -L -o \"{str(xray_zip_path)}\" \"{xray_zip_url}\""
+        p_dl = await asyncio.create_subprocess_shell(curl_cmd_dl, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        _, e_dl = await p_dl.communicate()
+        if p_dl.returncode != 0:
+            msg = f"Download failed: {e_dl.decode(errors='ignore')[:100]}"; log_fn(msg,True);
+            if xray_zip_path.exists(): xray_zip_path.unlink(); await show_modal_fn(msg + "\nInstall manually."); return False
+        log_fn("Extracting Xray...");
+        with zipfile.ZipFile(xray_zip_path, 'r') as z_ref:
+            xray_exe_in_zip = next((m for m in z_ref.namelist() if m.lower().endswith("xray") and not m.endswith(".sig") and not m.endswith(".dgst")), None)
+            if not xray_exe_in_zip:
+                msg = "No 'xray' exe in zip."; log_fn(msg,True); await show_modal_fn(msg); xray_zip_path.unlink(); return False
+            with z_ref.open(xray_exe_in_zip) as src, open(XRAY_PATH, "wb") as tgt: tgt.write(src.read())
+            log_fn(f"Extracted 'xray' to {XRAY_PATH}"); os.chmod(XRAY_PATH, 0o755); log_fn("Set Xray executable.")
+            if xray_zip_path.exists(): xray_zip_path.unlink()
+            msg_ok = "Xray core setup ok! Press 'c' or restart."; log_fn(msg_ok); await show_modal_fn(msg_ok); return True
+    except Exception as e:
+        msg = f"Error Xray setup: {e}"; log_fn(msg,True);
+        if 'xray_zip_path' in locals() and xray_zip_path.exists(): xray_zip_path.unlink()
+        await show_modal_fn(msg + "\nInstall Xray manually."); return False
+
+# --- Main Xray Process ---
+def write_main_config(server_config: ServerRecord) -> Path:
+    xray_json = generate_xray_config(server_config, MAIN_SOCKS_PORT, MAIN_HTTP_PORT)
+    if not xray_json: raise RuntimeError("Fail gen main Xray cfg.")
+    with open(LAST_SELECTED_CONFIG_FILE, "w") as f: json.dump(xray_json, f, indent=2)
+    return LAST_SELECTED_CONFIG_FILE
+
+def launch_main_xray(server_config: ServerRecord, detach: bool = False) -> subprocess.Popen:
+    # Blocking start for headless callers (the TUI uses XraySupervisor). Records the PID; detach=True puts Xray in
+    # its own session so it outlives the caller. Raises RuntimeError if it does not come up.
+    cfg_path = write_main_config(server_config)
+    proc = subprocess.Popen([str(XRAY_PATH),"run","-c",str(cfg_path)],stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL if detach else subprocess.PIPE, start_new_session=detach)
+    if wait_for_xray_ready_blocking(proc, [MAIN_SOCKS_PORT, MAIN_HTTP_PORT]):
+        with open(CURRENT_XRAY_PID_FILE, "w") as pf: pf.write(str(proc.pid))
+        return proc
+    if proc.poll() is None: proc.kill(); proc.wait()
+    err = proc.stderr.read().decode(errors="ignore")[:200] if proc.stderr else "N/A"
+    LAST_SELECTED_CONFIG_FILE.unlink(missing_ok=True)
+    raise RuntimeError(f"Fail start Xray. RC:{proc.returncode}. E:{err}")
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0]: return False # Our own child (e.g. `connect --watch` failover), now reaped
+    except ChildProcessError: pass # Started by another process
+    try: os.kill(pid, 0); return True
+    except OSError: return False
+
+def stop_main_xray() -> tuple[int | None, str, bool]:
+    # Stops the Xray recorded in CURRENT_XRAY_PID_FILE. Returns (pid or None if none recorded, message, is_error).
+    pid = None
+    if CURRENT_XRAY_PID_FILE.exists():
+        try: pid = int(open(CURRENT_XRAY_PID_FILE).read().strip())
+        except (OSError, ValueError): CURRENT_XRAY_PID_FILE.unlink(missing_ok=True)
+    if not pid: return None, "Main Xray not running/PID missing.", False
+    try:
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + XRAY_STOP_TIMEOUT
+        while _pid_alive(pid):
+            if time.monotonic() >= deadline: os.kill(pid, signal.SIGKILL); return pid, f"Force stopped Xray (PID:{pid}).", False
+            time.sleep(XRAY_READY_POLL_INTERVAL)
+        return pid, f"Stopped Xray (PID:{pid}).", False
+    except OSError: return pid, f"Xray (PID:{pid}) exited.", False # Already exited
+    except Exception as e: return pid, f"Err stop Xray PID {pid}: {e}", True
+    finally: CURRENT_XRAY_PID_FILE.unlink(missing_ok=True)
+
+class XraySupervisor:
+    # Owns the main Xray child inside a long-lived event loop: non-blocking start/stop/restart, Xray's output streamed
+    # to log_fn, and restart with exponential backoff when it dies on its own. on_state(state, server_config) fires
+    # on every transition between "stopped", "starting", "running" and "restarting". State lives here; the PID file
+    # is only kept for `vpn.py stop` and for cleaning up an Xray left behind by an earlier session.
+    def __init__(self, log_fn, on_state=None):
+        self.log_fn, self.on_state = log_fn, on_state or (lambda state, server_config: None)
+        self.state = "stopped"
+        self.server_config: ServerRecord | None = None
+        self.proc: asyncio.subprocess.Process | None = None
+        self.crashes, self.started_at = 0, 0.0
+        self._monitor: asyncio.Task | None = None
+        self._lock = asyncio.Lock() # Serializes start/stop/restart
+
+    @property
+    def pid(self) -> int | None: return self.proc.pid if self.proc else None
+
+    def _set_state(self, state: str) -> None:
+        self.state = state; self.on_state(state, self.server_config)
+
+    async def start(self, server_config: ServerRecord) -> bool:
+        async with self._lock:
+            await self._stop_locked()
+            self.server_config, self.crashes = server_config, 0
+            return await self._spawn()
+
+    async def restart(self) -> bool:
+        return await self.start(self.server_config) if self.server_config else False
+
+    async def stop(self) -> tuple[int | None, str, bool]:
+        # Same contract as stop_main_xray: (pid or None if nothing was running, message, is_error).
+        async with self._lock: return await self._stop_locked()
+
+    async def _spawn(self) -> bool:
+        self._set_state("starting")
+        try:
+            cfg_path = write_main_config(self.server_config)
+            proc = await asyncio.create_subprocess_exec(str(XRAY_PATH), "run", "-c", str(cfg_path), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        except (OSError, RuntimeError) as e:
+            self.log_fn(f"Ex start Xray: {e}", True); self._set_state("stopped"); return False
+        output = asyncio.create_task(self._pump_output(proc))
+        if not await wait_for_xray_ready(proc, [MAIN_SOCKS_PORT, MAIN_HTTP_PORT]):
+            await self._terminate(proc); await output
+            self.log_fn(f"Fail start Xray. RC:{proc.returncode}.", True); self._set_state("stopped"); return False
+        with open(CURRENT_XRAY_PID_FILE, "w") as pf: pf.write(str(proc.pid))
+        self.proc, self.started_at = proc, time.monotonic()
+        self._monitor = asyncio.create_task(self._watch(proc, output))
+        self._set_state("running"); return True
+
+    async def _pump_output(self, proc: asyncio.subprocess.Process) -> None:
+        async for line in proc.stdout:
+            if line.strip(): self.log_fn(f"xray: {line.decode(errors='ignore').rstrip()[:200]}")
+
+    async def _watch(self, proc: asyncio.subprocess.Process, output: asyncio.Task) -> None:
+        # Only returns on its own after an unexpected exit; stop() cancels it first.
+        rc = await proc.wait(); await output
+        self.proc = None; CURRENT_XRAY_PID_FILE.unlink(missing_ok=True)
+        if time.monotonic() - self.started_at > XRAY_STABLE_SECS: self.crashes = 0
+        while True:
+            delay = min(XRAY_RESTART_BASE_SECS * 2 ** self.crashes, XRAY_RESTART_MAX_SECS); self.crashes += 1
+            self.log_fn(f"Xray exited (RC:{rc}). Restarting in {delay:.0f}s (attempt {self.crashes}).", True)
+            self._set_state("restarting")
+            await asyncio.sleep(delay)
+            async with self._lock:
+                if await self._spawn(): return
+
+    async def _terminate(self, proc: asyncio.subprocess.Process) -> None:
+        if proc.returncode is not None: return
+        proc.terminate()
+        try: await asyncio.wait_for(proc.wait(), XRAY_STOP_TIMEOUT)
+        except asyncio.TimeoutError: proc.kill(); await proc.wait()
+
+    async def _stop_locked(self) -> tuple[int | None, str, bool]:
+        monitor, self._monitor = self._monitor, None
+        if monitor and monitor is not asyncio.current_task():
+            monitor.cancel()
+            try: await monitor
+            except asyncio.CancelledError: pass
+        proc, self.proc = self.proc, None
+        if proc is None:
+            was_restarting = self.state == "restarting"
+            if self.state != "stopped": self._set_state("stopped")
+            pid, msg, is_error = await asyncio.to_thread(stop_main_xray) # Xray left behind by an earlier session / headless connect
+            return (pid, msg, is_error) if pid or not was_restarting else (None, "Cancelled Xray restart.", False)
+        await self._terminate(proc)
+        CURRENT_XRAY_PID_FILE.unlink(missing_ok=True); self._set_state("stopped")
+        return proc.pid, f"Stopped Xray (PID:{proc.pid}, RC:{proc.returncode}).", False
+
+# --- Connection Watchdog ---
+class ConnectionWatchdog:
+    # Probes the live connection (end-to-end through MAIN_SOCKS_PORT, accept on MAIN_HTTP_PORT) and, when it stays
+    # dead or slow, switches to the next warm standby via switch_fn(ServerRecord) -> bool (awaitable).
+    def __init__(self, switch_fn, log_fn, interval: float = WATCHDOG_INTERVAL, standby_k: int = WATCHDOG_STANDBY_K,
+                 fail_threshold: int = WATCHDOG_FAIL_THRESHOLD, slow_ms: float = WATCHDOG_SLOW_MS, slow_threshold: int = WATCHDOG_SLOW_THRESHOLD):
+        self.switch_fn, self.log_fn, self.interval, self.standby_k = switch_fn, log_fn, interval, standby_k
+        self.fail_threshold, self.slow_ms, self.slow_threshold = fail_threshold, slow_ms, slow_threshold
+        self.current: ServerRecord | None = None
+        self.standby: list = [] # Result dicts, best first
+        self.fails = self.slow = self.failovers = 0
+        self.last_latency_ms: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def set_current(self, server_config: ServerRecord | None) -> None:
+        self.current, self.fails, self.slow = server_config, 0, 0
+        if server_config: self.standby = [r for r in self.standby if r["config"].key != server_config.key]
+
+    def set_standby(self, results: list) -> None:
+        cur = self.current.key if self.current else None
+        self.standby = [r for r in results if r["config"].key != cur][:self.standby_k]
+
+    @property
+    def running(self) -> bool: return self._task is not None and not self._task.done()
+
+    def start(self) -> asyncio.Task:
+        if not self.running: self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self) -> None:
+        if not self.running: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+
+    async def probe_once(self) -> tuple[bool, float | None, str]:
+        # Returns (ok, latency_ms, detail).
+        try:
+            timings = await socks5_http_probe(MAIN_SOCKS_PORT)
+            _, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", MAIN_HTTP_PORT), PROBE_CONNECT_TIMEOUT)
+            writer.close()
+        except ProbeError as e: return False, None, f"Probe:{e}"
+        except (OSError, asyncio.TimeoutError) as e: return False, None, f"HTTP:{type(e).__name__}"
+        return True, timings["total_ms"], f"{int(timings['total_ms'])}ms"
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(WATCHDOG_RETRY_INTERVAL if self.fails else self.interval)
+            if self.current is None: continue
+            ok, latency_ms, detail = await self.probe_once()
+            self.last_latency_ms = latency_ms
+            self.fails = 0 if ok else self.fails + 1
+            self.slow = self.slow + 1 if ok and latency_ms > self.slow_ms else 0
+            if self.fails >= self.fail_threshold: await self.failover(f"{self.fails} failed probes ({detail})")
+            elif self.slow >= self.slow_threshold: await self.failover(f"{self.slow} slow probes ({detail})")
+
+    async def failover(self, reason: str) -> bool:
+        dead = self.current
+        self.log_fn(f"Watchdog: '{dead.name if dead else '?'}' unhealthy: {reason}.", True)
+        while self.standby:
+            nxt = self.standby.pop(0)["config"]
+            self.log_fn(f"Watchdog: failing over to '{nxt.name}'.")
+            if await self.switch_fn(nxt):
+                self.set_current(nxt); self.failovers += 1
+                return True
+        self.log_fn("Watchdog: no standby left. Update & test with 'u'.", True)
+        self.fails = self.slow = 0 # Keep probing the current server; it may recover
+        return False
@@ -0,0 +1,354 @@
+import bisect
+import os
+
+# --- Textual App Imports ---
+from textual.app import App, ComposeResult
+from textual.widgets import Header, Footer, Button, Static, Log, Input, Label, Markdown, DataTable
+from textual.containers import Horizontal, Vertical
+from textual.reactive import reactive
+from textual.screen import ModalScreen
+from textual.binding import Binding
+
+from vpn_core import (
+    APP_SUB_TITLE, APP_TITLE, APP_VERSION, DEVELOPER_EMAIL_CONST, DEVELOPER_NAME_CONST, HEALTH_DB_FILE, INITIAL_CONCURRENT_TESTS, LOG_FLUSH_INTERVAL,
+    LOG_WIDGET_MAX_LINES, MAIN_HTTP_PORT, MAIN_SOCKS_PORT, MAX_CONCURRENT_TESTS, METRICS, METRICS_JSON_FILE, METRICS_PROM_FILE, PROFILE_FILE, SCRIPT_DIR,
+    TEST_BATCH_SIZE, XRAY_PATH, ConnectionWatchdog, HealthStore, HttpClient, LogBuffer, ServerRecord, UpdatePipeline, XraySupervisor, load_last_results,
+    load_subs_cache, load_subscriptions,
+    rank_key, run_profiled, save_last_results, save_subs_cache, save_subscriptions, setup_xray_core, throughput_rank_key,
+)
+
+SERVER_TABLE_SORT_DELAY = 0.3 # Coalesce re-sorts while results stream in
+
+# --- Textual Screens ---
+class AddSubScreen(ModalScreen):
+    BINDINGS = [Binding("escape", "pop_screen", "Back", show=False)]
+    def compose(self) -> ComposeResult: yield Vertical(Label("Subscription URL:"), Input(id="sub_url_input"), Horizontal(Button("Add",variant="primary",id="add_sub_button"), Button("Cancel",id="cancel_add_sub_button"), classes="modal_buttons"),id="add_sub_dialog")
+    async def on_button_pressed(self, event: Button.Pressed) -> None: self.dismiss(self.query_one(Input).value.strip() if event.button.id == "add_sub_button" else None)
+
+class MessageScreen(ModalScreen):
+    BINDINGS = [Binding("escape", "pop_screen", "OK", show=False)]
+    def __init__(self, message: str) -> None: super().__init__(); self.message = message
+    def compose(self) -> ComposeResult: yield Vertical(Markdown(self.message), Button("OK",variant="primary",id="ok_button"),id="message_dialog")
+    def on_button_pressed(self, event: Button.Pressed) -> None: self.dismiss()
+
+class AboutScreen(ModalScreen):
+    BINDINGS = [Binding("escape", "pop_screen", "Back", show=False)]
+    def compose(self) -> ComposeResult: yield Vertical(Markdown(f"# {APP_TITLE} v{APP_VERSION}\n{APP_SUB_TITLE}\n\n---\nDev: **{DEVELOPER_NAME_CONST}** ({DEVELOPER_EMAIL_CONST})\n\nPowered by Textual & Xray."),Button("OK",id="ok_about_button"),id="about_dialog", classes="about_content")
+    def on_button_pressed(self, event: Button.Pressed) -> None: self.dismiss()
+
+# --- Main Application ---
+class VpnApp(App[None]): # Added type hint for exit value
+    CSS_PATH = "vpn_style.tcss"
+    TITLE = APP_TITLE
+    SUB_TITLE = APP_SUB_TITLE
+
+    BINDINGS = [
+        Binding("q", "quit_app", "Quit"), Binding("a", "add_subscription_action", "Add Sub"),
+        Binding("u", "update_and_test_subs_action", "Update & Test All"),
+        Binding("U", "update_and_test_subs_action(True)", "Full Retest", show=False),
+        Binding("x", "connect_best", "Connect Best"), Binding("s", "stop_xray_action", "Stop Xray"), Binding("c", "check_xray_path_action", "Check Xray"),
+        Binding("b", "throughput_test", "Bandwidth Test"), Binding("m", "toggle_metrics", "Metrics"), Binding("d", "dump_metrics", "Dump Metrics", show=False),
+        Binding("P", "update_and_test_subs_action(False, True)", "Profiled Update", show=False),
+        Binding("f1", "show_about_screen", "About"),
+    ]
+
+    subscriptions = reactive(load_subscriptions)
+    rank_by = "score" # "throughput" after a bandwidth test ('b'); the next update resets it
+    active_servers: list = [] # Result dicts sorted by rank_key (composite score); mirrored row-for-row (after sort) in #server_table
+    active_log_message = reactive("App Started.")
+    is_testing_servers = reactive(False)
+
+    def on_mount(self) -> None:
+        self.logs, self._status_message = LogBuffer(), None; self.set_interval(LOG_FLUSH_INTERVAL, self.flush_log)
+        self.query_one("#subscriptions_table", DataTable).add_columns("Name", "URL", "Updated")
+        servers_t = self.query_one("#server_table", DataTable); self._sort_pending = False
+        self.set_interval(SERVER_TABLE_SORT_DELAY, self._sort_if_pending) # Timer task, not a queued message: fires while the pump is busy
+        for label, key in (("Score", "score"), ("MB/s", "mbps"), ("Median", "median"), ("p90", "p90"), ("Jitter", "jitter"), ("Loss", "loss"), ("Seen", "seen"), ("Name", "name"), ("Type", "type"), ("Address", "address")):
+            servers_t.add_column(label, key=key)
+        self.health = HealthStore(HEALTH_DB_FILE)
+        self.xray = XraySupervisor(self.log_to_widget, self._on_xray_state)
+        self.watchdog = ConnectionWatchdog(self.start_xray, self.log_to_widget)
+        self.http = HttpClient(); self.subs_cache = load_subs_cache()
+        self.log_to_widget(f"Welcome to {self.TITLE} v{APP_VERSION}!");
+        self.active_servers = []; cached = load_last_results() # Stale-while-revalidate: last run's servers are listed (and connectable) right away
+        for res in cached: self.add_active_server(res)
+        if cached: self.watchdog.set_standby(self.active_servers); self.log_to_widget(f"Loaded {len(cached)} servers from last run (stale until retested).")
+        self.query_one("#metrics_panel", Static).display = False; self.set_interval(1.0, self.refresh_metrics_panel)
+        self.call_later(self.check_xray_path_and_setup, silent=True)
+        if self.subscriptions: self.call_later(self.action_update_and_test_subs_action)
+
+    def log_to_widget(self, message: str, is_error: bool = False, fold: str | None = None):
+        self.logs.log(message, is_error, fold) # Shown by the next flush_log tick, so a burst costs one redraw
+        if not is_error or "Xray NOT found" in message : self._status_message = message # Update status bar for important errors too
+
+    def flush_log(self) -> None:
+        if lines := self.logs.flush():
+            try: self.query_one("#main_log", Log).write_lines(lines)
+            except Exception: pass # Called during shutdown
+        if self._status_message is not None: self.active_log_message, self._status_message = self._status_message, None
+
+    def on_unmount(self) -> None: self.logs.flush() # Last lines still reach the log file
+
+    async def show_message_modal(self, message: str):
+        if self.is_running: await self.push_screen(MessageScreen(message))
+
+    async def check_xray_path_and_setup(self, silent: bool = False) -> bool:
+        status_w = self.query_one("#xray_path_status", Static)
+        if not XRAY_PATH.exists() or not os.access(XRAY_PATH, os.X_OK):
+            msg = f"Xray NOT found/exec: {XRAY_PATH}"; status_w.update(f"[b red]{msg}[/b red]")
+            if not silent:
+                tip = f"\nAuto-setup will try. Else, download Xray, place in '{SCRIPT_DIR}', then `chmod +x xray`."
+                self.log_to_widget(msg + tip, True); await self.show_message_modal(msg + tip + "\n\nStarting auto-setup...")
+                if await setup_xray_core(self.log_to_widget, self.show_message_modal):
+                    return await self.check_xray_path_and_setup(silent=True) # Re-check after setup
+                else: return False # Setup failed
+            else: # This else corresponds to "if not silent"
+                self.log_to_widget(msg, True); return False
+        else: # This else corresponds to "if not XRAY_PATH.exists() or not os.access(XRAY_PATH, os.X_OK):"
+            ok_msg = f"Xray OK: {XRAY_PATH}"; status_w.update(f"[b green]{ok_msg}[/b green]")
+            if not silent: self.log_to_widget(ok_msg)
+            return True
+
+    async def action_check_xray_path_action(self) -> None: await self.check_xray_path_and_setup(silent=False)
+    async def action_show_about_screen(self) -> None: await self.push_screen(AboutScreen())
+
+    async def start_xray(self, server_config: ServerRecord) -> bool:
+        if not XRAY_PATH.exists() or not os.access(XRAY_PATH, os.X_OK): self.log_to_widget(f"Xray NOT found/exec: {XRAY_PATH}", True); return False
+        self.log_to_widget(f"Starting Xray with '{server_config.name}'.")
+        if not await self.xray.start(server_config): return False
+        self.log_to_widget(f"Xray started (PID:{self.xray.pid}). SOCKS:{MAIN_SOCKS_PORT} HTTP:{MAIN_HTTP_PORT}")
+        self.watchdog.set_current(server_config); self.watchdog.start()
+        return True
+
+    async def stop_xray(self) -> bool:
+        self.watchdog.set_current(None) # Nothing to watch until the next start
+        pid, msg, is_error = await self.xray.stop()
+        if pid is None: return False
+        self.log_to_widget(msg, is_error); return True
+
+    def _on_xray_state(self, state: str, server_config: ServerRecord | None) -> None:
+        name = server_config.name if server_config else "?"
+        text = {"starting": f"[b yellow]Xray Starting: {name}[/b yellow]", "running": f"[b cyan]Xray Active: {name}[/b cyan]",
+                "restarting": f"[b red]Xray Restarting: {name}[/b red]"}.get(state, "Xray Inactive")
+        try: self.query_one("#xray_path_status", Static).update(text)
+        except Exception: pass # Called during shutdown
+
+    async def _connect_worker(self, server_config: ServerRecord) -> None:
+        if await self.start_xray(server_config): await self.show_message_modal(f"Xray started with: '{server_config.name}'")
+        else: await self.show_message_modal("Failed to start Xray.")
+
+    async def _stop_worker(self) -> None:
+        if await self.stop_xray(): await self.show_message_modal("Main Xray stopped.")
+        else: await self.show_message_modal("Main Xray not running/PID missing.")
+
+    def action_stop_xray_action(self) -> None: self.run_worker(self._stop_worker(), group="xray")
+
+    async def action_add_subscription_action(self) -> None:
+        if self.is_testing_servers: await self.show_message_modal("Server testing in progress."); return
+        new_url = await self.push_screen(AddSubScreen())
+        if new_url:
+            if any(s.get('url')==new_url for s in self.subscriptions):
+                msg=f"URL '{new_url[:30]}...' exists."; self.log_to_widget(msg); await self.show_message_modal(msg); return
+            idx = 1; new_name = f"Sub_{idx}"
+            while new_name in {s.get("name") for s in self.subscriptions}: idx+=1; new_name=f"Sub_{idx}"
+            self.subscriptions = self.subscriptions + [{"name":new_name, "url":new_url, "last_update":"Never"}] # type: ignore
+            save_subscriptions(self.subscriptions); self.log_to_widget(f"Added: {new_name}");
+            self.call_later(self.action_update_and_test_subs_action)
+        else: self.log_to_widget("Add sub cancelled.")
+
+    async def action_update_and_test_subs_action(self, force_full: bool = False, profile: bool = False) -> None:
+        if self.is_testing_servers: await self.show_message_modal("Test already in progress."); return
+        if not self.subscriptions: await self.show_message_modal("No subs. Add with 'a'."); return
+        if not XRAY_PATH.exists() or not os.access(XRAY_PATH, os.X_OK): # Every test would fail locally: refresh the subscriptions only
+            self.log_to_widget(f"Xray NOT found/exec: {XRAY_PATH}. Updating subs only, no tests. Press 'c' to set it up.", True)
+            self.is_testing_servers = True; self.run_worker(self._update_and_test(force_full, profile, test=False), group="update", exclusive=True); return
+        self.is_testing_servers = True; table = self.query_one("#server_table", DataTable)
+        if self.rank_by != "score": self.rank_by = "score"; self.active_servers.sort(key=rank_key); self._sort_pending = True # add_active_server insorts by rank_key
+        for res in self.active_servers: # Keep the list usable while retesting; entries not confirmed by this run are dropped at the end
+            res["stale"] = True; table.update_cell(res["config"].key, "seen", "stale")
+        self.update_active_server_list_ui()
+        self.query_one("#active_server_count", Static).update("[b yellow]Updating & Testing...[/b yellow]")
+        self.log_to_widget(f"Updating subs & testing servers (batches of {TEST_BATCH_SIZE}, {INITIAL_CONCURRENT_TESTS}-{MAX_CONCURRENT_TESTS} Xray concurrent)...")
+        self.run_worker(self._update_and_test(force_full, profile), group="update", exclusive=True) # Off the message pump: keys, 'x' and row selects stay live
+
+    async def _update_and_test(self, force_full: bool, profile: bool, test: bool = True) -> None:
+        pipeline = UpdatePipeline(self.http, self.health, self.subs_cache, self.log_to_widget, self.add_active_server, force_full)
+        try:
+            run = pipeline.run(list(self.subscriptions), test)
+            updated_subs_list = await (run_profiled(run, PROFILE_FILE) if profile else run)
+            if profile: self.log_to_widget(f"Profile saved: {PROFILE_FILE} (python -m pstats)")
+            self.subscriptions = updated_subs_list # Update reactive list with new timestamps etc.
+            save_subscriptions(self.subscriptions)
+            live_urls = {s.get("url") for s in updated_subs_list}
+            save_subs_cache({u: c for u, c in self.subs_cache.items() if u in live_urls})
+            if not test: self.log_to_widget(f"Subs updated ({pipeline.stats['links']} links), servers not tested."); return
+            if pipeline.stats["subs_fetched"]: self.drop_stale_servers(); save_last_results(self.active_servers)
+            else: self.log_to_widget("No subscription could be fetched: keeping last run's servers.", True) # Offline or outage: don't wipe the list
+            st = pipeline.stats; self.watchdog.set_standby(self.active_servers)
+            self.log_to_widget(f"Testing complete. Links: {st['links']}, unique configs: {st['parsed']}, fresh: {st['fresh']}, backed off: {st['backed_off']}, screened out: {st['screened_out']}, tested: {st['tested']} (final concurrency {st['concurrency']}). Active servers: {len(self.active_servers)}")
+        except Exception as e: self.log_to_widget(f"Ex during update: {e}", True)
+        finally: self.is_testing_servers = False
+
+    def add_active_server(self, result: dict) -> None:
+        # Streamed in from the pipeline: O(1) row append (or in-place refresh of a cached row); the table is re-sorted at most every SERVER_TABLE_SORT_DELAY.
+        conf, st = result["config"], result.get("stats") or {"median_ms": result.get("latency_ms")}
+        table = self.query_one("#server_table", DataTable)
+        ms = lambda v: int(v) if v is not None else None
+        tp = (result.get("throughput") or {}).get("bytes_per_sec")
+        cells = {"score": ms(result.get("score")), "mbps": round(tp / 1e6, 2) if tp else None, "median": ms(st.get("median_ms")), "p90": ms(st.get("p90_ms")),
+                 "jitter": ms(st.get("jitter_ms")), "loss": f"{st['loss']:.0%}" if st.get("loss") is not None else "", "seen": "stale" if result.get("stale") else "live"}
+        if conf.key in table.rows:
+            old = next((r for r in self.active_servers if r["config"].key == conf.key), None)
+            if old is not None: self.active_servers.remove(old)
+            if not tp and old and old.get("throughput"): result["throughput"] = old["throughput"]; cells.pop("mbps") # Keep the last bandwidth figure
+            for col, value in cells.items(): table.update_cell(conf.key, col, value)
+        else:
+            tls = conf.security.upper() if conf.security != "none" else "NoTLS"
+            table.add_row(*cells.values(), conf.name, f"{conf.protocol}/{conf.network}/{tls}", conf.address, key=conf.key)
+        bisect.insort(self.active_servers, result, key=rank_key)
+        self._sort_pending = True
+        self.update_active_server_list_ui()
+
+    def drop_stale_servers(self) -> None:
+        # After a revalidation: whatever the run did not confirm is gone (dead, or removed from its subscription).
+        table, stale = self.query_one("#server_table", DataTable), [r for r in self.active_servers if r.get("stale")]
+        for res in stale: table.remove_row(res["config"].key)
+        if stale: self.active_servers = [r for r in self.active_servers if not r.get("stale")]; self.log_to_widget(f"Dropped {len(stale)} stale servers.")
+        self.update_active_server_list_ui()
+
+    def _sort_if_pending(self) -> None:
+        if self._sort_pending: self._sort_server_table()
+
+    def _sort_server_table(self) -> None:
+        self._sort_pending = False; table = self.query_one("#server_table", DataTable)
+        if self.rank_by == "throughput":
+            table.sort("mbps", "score", "median", key=lambda v: throughput_rank_key({"throughput": {"bytes_per_sec": v[0]}, "score": v[1], "latency_ms": v[2]}))
+        else: table.sort("score", "median", key=lambda v: rank_key({"score": v[0], "latency_ms": v[1]}))
+
+    async def action_throughput_test(self) -> None:
+        # Second stage on demand: bandwidth-test the best-scored servers, then rank by sustained throughput.
+        if self.is_testing_servers: await self.show_message_modal("Test already in progress."); return
+        if not self.active_servers: await self.show_message_modal("No active servers. Update/Test with 'u'."); return
+        self.is_testing_servers = True; self.update_active_server_list_ui()
+        self.run_worker(self._throughput_test(), group="update", exclusive=True)
+
+    async def _throughput_test(self) -> None:
+        pipeline = UpdatePipeline(self.http, self.health, self.subs_cache, self.log_to_widget, lambda _: None)
+        try:
+            tested, table = await pipeline.run_throughput(self.active_servers), self.query_one("#server_table", DataTable)
+            for res in tested:
+                bps = res["throughput"]["bytes_per_sec"]
+                table.update_cell(res["config"].key, "mbps", round(bps / 1e6, 2) if bps else None)
+            self.rank_by = "throughput"; self.active_servers.sort(key=throughput_rank_key); self._sort_server_table()
+            self.watchdog.set_standby(self.active_servers); save_last_results(self.active_servers)
+            if tested and (best := self.active_servers[0]).get("throughput"): self.log_to_widget(f"Fastest: {best['config'].name} {best['throughput']['message']}")
+        except Exception as e: self.log_to_widget(f"Ex during throughput test: {e}", True)
+        finally: self.is_testing_servers = False
+
+    def compose(self) -> ComposeResult:
+        yield Header();
+        with Vertical(id="main_layout"):
+            with Horizontal(id="status_bar"):
+                yield Static("Xray status...",id="xray_path_status",classes="status_item")
+                yield Static("",id="active_server_count",classes="status_item status_count")
+                yield Static(self.active_log_message,id="active_log_display",classes="status_item status_log") # type: ignore
+            yield Label("Subscriptions:",classes="section_header")
+            yield DataTable(id="subscriptions_table",classes="list_container_subs",show_cursor=False)
+            yield Label("Active Servers (Sorted by Score, ms; Enter/click to connect):",classes="section_header")
+            yield Static("",id="server_list_info",classes="placeholder_text")
+            yield DataTable(id="server_table",classes="list_container_servers",cursor_type="row",zebra_stripes=True)
+            yield Static("",id="metrics_panel",markup=False)
+            yield Label("Log:",classes="section_header")
+            yield Log(id="main_log",auto_scroll=True,max_lines=LOG_WIDGET_MAX_LINES,highlight=True)
+        yield Footer();
+        self.call_later(self.update_subscription_list_ui);
+        self.call_later(self.update_active_server_list_ui)
+
+    async def watch_subscriptions(self, _:list, new_s:list) -> None: self.update_subscription_list_ui() # type: ignore
+
+    def update_subscription_list_ui(self):
+        t = self.query_one("#subscriptions_table",DataTable); t.clear() # Few rows: a full rebuild is cheap
+        if not self.subscriptions: t.add_row("No subs. 'a' to add.", "", ""); return
+        for i,s in enumerate(self.subscriptions):
+            n,u,tm = s.get("name",f"S_{i+1}"),s.get("url","N/A"),s.get("last_update","Never")
+            t.add_row(n, u[:35]+"..." if len(u)>38 else u, tm)
+
+    async def watch_is_testing_servers(self, old_val: bool, new_val: bool) -> None:
+        if old_val and not new_val: self.update_active_server_list_ui() # Testing just finished
+
+    def update_active_server_list_ui(self):
+        # O(1): rows live in the DataTable (which only renders visible lines); this only refreshes the counters.
+        n = len(self.active_servers)
+        if self.is_testing_servers:
+            cnt_str, info = "[b #FFFF00]Testing...[/]", f"Testing servers... {n} active so far." if n else "Testing servers..."
+        elif n:
+            stale = sum(1 for r in self.active_servers if r.get("stale"))
+            cnt_str, info = f"[b #00FF00]Active: {n}[/]", f"Showing {n} active server(s)." + (f" {stale} from last run, not yet retested." if stale else "")
+        else: cnt_str, info = "[b #FF0000]No active servers.[/]", "No active servers. Update/Test with 'u'."
+        self.query_one("#active_server_count",Static).update(cnt_str); self.query_one("#server_list_info",Static).update(info)
+
+    def action_toggle_metrics(self) -> None:
+        panel = self.query_one("#metrics_panel", Static); panel.display = not panel.display; self.refresh_metrics_panel()
+
+    def refresh_metrics_panel(self) -> None:
+        panel = self.query_one("#metrics_panel", Static)
+        if panel.display: panel.update("\n".join(METRICS.summary_lines()))
+
+    def action_dump_metrics(self) -> None:
+        try: self.log_to_widget(f"Metrics saved: {METRICS.dump(METRICS_JSON_FILE)}, {METRICS.dump(METRICS_PROM_FILE)}")
+        except OSError as e: self.log_to_widget(f"Err save metrics: {e}", True)
+
+    async def watch_active_log_message(self, _:str, new_msg:str)->None:
+        try: self.query_one("#active_log_display",Static).update(new_msg[:65]) # Limit length
+        except: pass
+
+    async def on_data_table_row_selected(self, event: DataTable.RowSelected) -> None:
+        if event.data_table.id != "server_table": return
+        s_info = next((r for r in self.active_servers if r["config"].key == event.row_key.value), None)
+        if s_info is None: await self.show_message_modal("No active servers to connect."); return
+        s_to_conn = s_info["config"]
+        self.log_to_widget(f"Connect selected: {s_to_conn.name}"); self.watchdog.set_standby(self.active_servers)
+        self.run_worker(self._connect_worker(s_to_conn), group="xray") # Start/stop run off the message loop
+
+    async def action_connect_best(self) -> None:
+        if not self.active_servers: await self.show_message_modal("No active servers to connect."); return
+        best = self.active_servers[0]["config"]
+        self.log_to_widget(f"Connect best: {best.name}"); self.watchdog.set_standby(self.active_servers)
+        self.run_worker(self._connect_worker(best), group="xray")
+
+    async def action_quit_app(self) -> None:
+        self.log_to_widget("Quit requested. Stopping Xray...")
+        for worker in self.workers.cancel_group(self, "update"): # A running update/bandwidth test still uses health and http
+            try: await worker.wait()
+            except Exception: pass
+        await self.watchdog.stop(); await self.stop_xray(); self.health.close(); self.http.close()
+        self.log_to_widget("Exiting application."); self.exit()
+
+VPN_APP_CSS_FALLBACK = """
+                                                Screen { background: $surface; color: $text; layout: vertical; overflow-y: auto; }
+                                                Header { dock: top; background: $primary; color: $text; height: 1; text-style: bold; }
+                                                Footer { dock: bottom; background: $primary-darken-2; color: $text-muted; height: 1; }
+                                                #main_layout { padding: 0 1; height: 1fr; }
+                                                #status_bar { height: 1; background: $surface-darken-1; padding: 0 1; dock: top; grid-size: 3; grid-columns: 1fr auto 2fr; column-spacing: 1;}
+                                                #xray_path_status { width: 100%; content-align: left middle; color: $text-muted; overflow: hidden; text-overflow: ellipsis;}
+                                                #active_server_count { width: auto; content-align: center middle; padding: 0 1; } /* Auto width for count */
+                                                #active_log_display { width: 100%; content-align: right middle; color: $text-muted; overflow: hidden; text-overflow: ellipsis;}
+                                                .section_header { padding: 1 0 0 0; text-style: bold underline; color: $secondary; }
+                                                .list_container_subs { border: round $primary-background-darken-2; height: auto; max-height: 7; margin-bottom: 1; }
+                                                .list_container_servers { border: round $primary-background-darken-2; height: 1fr; margin-bottom: 1; } /* Virtualized DataTable */
+                                                #server_list_info { padding: 0; text-align: left; }
+                                                #metrics_panel { border: round $primary-background-darken-2; height: auto; max-height: 12; color: $text-muted; }
+                                                #main_log { border: panel $primary-background-darken-2; height: 7; margin-top: 1; }
+                                                .placeholder_text { color: $text-muted; padding: 1; text-align: center; }
+                                                #add_sub_dialog, #message_dialog, #about_dialog { padding:0 1; width:80%; max-width:60; height:auto; border:thick $secondary; background:$panel; }
+                                                .modal_label { padding: 1 0; }
+                                                .modal_buttons { padding-top: 1; align-horizontal: right; } .modal_buttons Button { margin-left: 1; }
+                                                .about_content Markdown { padding: 1 2; }
+                                                """
+
+def run_tui() -> None:
+    css_f = SCRIPT_DIR / VpnApp.CSS_PATH
+    if not css_f.exists():
+        with open(css_f, "w") as f: f.write(VPN_APP_CSS_FALLBACK)
+        print(f"Created CSS: {css_f} with fallback.")
+    VpnApp().run()